@@ -1,125 +1,1698 @@
 import subprocess
 import os
+import signal
+import json
+import logging
 import re
 import streamlit as st
 import tempfile
 import shutil
+import hashlib
+import threading
+import time
+import uuid
+import difflib
+import base64
+import zlib
+import unicodedata
+import html
+import hmac
+import contextlib
+from array import array
+from bisect import bisect_right
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+
+# --- LOGGING (EIGENER HANDLER, DA STREAMLIT NUR SEINE EIGENEN LOGGER KONFIGURIERT) ---
+logger = logging.getLogger("iustwrite")
+if not logger.handlers:  # Das Skript läuft bei jedem Rerun erneut
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.setLevel(os.environ.get("IUSTWRITE_LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+
+def silence_bare_mode():
+    """Ohne laufende App (batch.py, bench.py) meldet Streamlit nur "missing ScriptRunContext"-Warnungen.
+
+    Die Konfiguration wird zuerst geladen, sonst setzt sie das Log-Level beim ersten Zugriff zurück.
+    """
+    from streamlit import config as st_config, logger as st_logger
+    st_config.get_option("logger.level")
+    st_logger.set_log_level("error")
+
+# Beim Import ohne Server: vor den gecachten Singletons weiter unten, die sonst schon warnen
+if not st.runtime.exists():
+    silence_bare_mode()
+
+# Erst danach importieren: das Paket meldet ohne laufende App schon beim Import eine Warnung
 from streamlit_local_storage import LocalStorage
-from streamlit_autorefresh import st_autorefresh
 
-# --- OPTIMIERTE PARSER KLASSE ---
-class KlausurDocument:      
-    def __init__(self):
-        self.prefix_patterns = {
-            1: r'^\s*(Teil|Tatkomplex|Aufgabe)\s+\d+(\.|)(\s|$)',
-            2: r'^\s*[A-H]\.(\s|$)',
-            3: r'^\s*(I|II|III|IV|V|VI|VII|VIII|IX|X|XI|XII|XIII|XIV|XV|XVI|XVII|XVIII|XIX|XX)\.(\s|$)',
-            4: r'^\s*\d+\.(\s|$)',
-            5: r'^\s*[a-z]\)\s*',
-            6: r'^\s*[a-z]{2}\)\s*',   
-            7: r'^\s*\(\d+\)\s*',       
-            8: r'^\s*\([a-z]\)\s*', 
-            9: r'^\s*\([a-z]{2}\)\s*' 
-        }
+# Eintrag der Gliederung (Sidebar): Zeilennummer, Ebene, Sternchen, fett, Originaltext
+OutlineEntry = namedtuple("OutlineEntry", ["line", "level", "starred", "bold", "text"])
+
+# Übersetzungstabelle für Sonderzeichen im Fließtext; { } ~ und \ bleiben für eigene Befehle erhalten
+LATEX_ESCAPES = {"&": r"\&", "%": r"\%", "$": r"\$", "#": r"\#", "_": r"\_", "^": r"\^{}"}
+# Ein Token pro Fundstelle: Fußnote, Befehl/escaptes Zeichen oder zu entschärfendes Sonderzeichen
+ESCAPE_TOKEN_RE = re.compile(r"\\fn\(|\\(?:[A-Za-z@]+|.)|[&%$#_^]")
+# Befehle, deren erstes Argument wörtlich gesetzt wird (URLs): dort wird nichts escapt
+VERBATIM_ARG_COMMANDS = {"\\url", "\\href"}
+
+# --- GLIEDERUNGSSCHEMATA (DEKLARATIV) ---
+# Je Ebene eine Marken-Vorlage (oder eine Liste von Vorlagen). Platzhalter: {#} Zahl,
+# {A} Großbuchstabe A-H, {I} römische Zahl (I-XXXIX), {a} Kleinbuchstabe, {aa} zwei Kleinbuchstaben.
+# - Vorlagen auf "." verlangen danach Leerzeichen/Zeilenende; Sternchen-Form: "*" statt ".".
+# - Vorlagen auf ")" greifen auch direkt vor Text; Sternchen-Form: ")*" (mit Leerzeichen danach).
+# - Wort-Vorlagen ("Teil {#}", "{#}. Teil") bestehen aus zwei Wörtern; "." oder "*" dürfen folgen.
+# Optional je Schema: "befehle" (LaTeX-Befehl je Ebene), "einzug" (TOC-Einzug in em), "fett" (Ebenen).
+GLIEDERUNGSSCHEMATA = {
+    "jurabook": {
+        "titel": "Jurabook: Teil 1 · A. · I. · 1. · a) · aa) · (1) · (a) · (aa)",
+        "ebenen": [["Teil {#}", "Tatkomplex {#}", "Aufgabe {#}"], "{A}.", "{I}.", "{#}.",
+                   "{a})", "{aa})", "({#})", "({a})", "({aa})"],
+    },
+    "trier": {
+        "titel": "Trier: 1. Teil · A. · I. · 1. · a) · aa) · (1) · (a) · (aa)",
+        "ebenen": [["{#}. Teil", "{#}. Tatkomplex", "{#}. Aufgabe"], "{A}.", "{I}.", "{#}.",
+                   "{a})", "{aa})", "({#})", "({a})", "({aa})"],
+    },
+    "goettingen": {
+        "titel": "Göttingen: A. · I. · 1. · a) · aa) · (1) · (a) · (aa)",
+        "ebenen": ["{A}.", "{I}.", "{#}.", "{a})", "{aa})", "({#})", "({a})", "({aa})"],
+    },
+    "stgallen": {
+        "titel": "St. Gallen: I. · A. · 1. · a) · aa) · (1) · (a) · (aa)",
+        "ebenen": ["{I}.", "{A}.", "{#}.", "{a})", "{aa})", "({#})", "({a})", "({aa})"],
+    },
+}
+GLIEDERUNG_STANDARD = "jurabook"
+GLIEDERUNG_BEFEHLE = ("section*", "subsection*") + ("subsubsection*",) * 7
+GLIEDERUNG_EINZUG = (0.0, -1.4, -1.6, -0.6, 0.4, 1.4, 2.4, 3.4, 4.4)
+
+def _roemisch(zahl):
+    ziffern = ((10, "X"), (9, "IX"), (5, "V"), (4, "IV"), (1, "I"))
+    out = []
+    for wert, zeichen in ziffern:
+        while zahl >= wert:
+            out.append(zeichen)
+            zahl -= wert
+    return "".join(out)
 
-        # Falls du die Sternchen-Logik (versteckte Gliederung) 
-        # ebenfalls erweitern willst, hier das neue Pattern:
-        self.star_patterns = {
-            1: r'^\s*(Teil|Tatkomplex|Aufgabe)\s+\d+\*(\s|$)',
-            2: r'^\s*[A-H]\*(\s|$)',   # KEIN Punkt vor dem Stern!
-            3: r'^\s*(I|II|III|IV|V|VI|VII|VIII|IX|X|XI|XII|XIII|XIV|XV|XVI|XVII|XVIII|XIX|XX)\*(\s|$)',
-            4: r'^\s*\d+\*(\s|$)',
-            5: r'^\s*[a-z]\)\*(\s|$)'
+KLEINBUCHSTABEN = "abcdefghijklmnopqrstuvwxyz"
+MARKEN_PLATZHALTER = {
+    "{#}": ("#",),
+    "{A}": tuple("ABCDEFGH"),  # ohne I/V/X, sonst mit römischen Zahlen verwechselbar
+    "{I}": tuple(_roemisch(n) for n in range(1, 40)),
+    "{a}": tuple(KLEINBUCHSTABEN),
+    "{aa}": tuple(x + y for x in KLEINBUCHSTABEN for y in KLEINBUCHSTABEN),
+}
+MARKEN_PLATZHALTER_RE = re.compile(r"\{(?:#|A|I|a|aa)\}")
+ZIFFERN_RE = re.compile(r"\d+")
+
+class Gliederungsschema:
+    """Kompilierte Form eines Eintrags aus GLIEDERUNGSSCHEMATA.
+
+    Alle zulässigen Marken stehen vorab ausgeschrieben in Dicts (Zahlen als "#"), die
+    Erkennung einer Zeile ist damit ein bis drei Dict-Zugriffe statt einer Regex-Kaskade.
+    """
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.titel = spec.get("titel", name)
+        self.marken = {}     # ganzes erstes Wort -> (starred, level)
+        self.praefixe = {}   # Anfang bis zur ersten ")" -> (starred, level)
+        self.paare = {}      # "erstes zweites" Wort -> (starred, level)
+        self.paarwoerter = set()
+        normal = []
+        stern = []
+        for level, vorlagen in enumerate(spec["ebenen"], start=1):
+            if isinstance(vorlagen, str):
+                vorlagen = [vorlagen]
+            for vorlage in vorlagen:
+                for marke in self._expand(vorlage):
+                    if " " in marke:
+                        erstes, zweites = marke.split(" ")
+                        self.paarwoerter.update(w for w in (erstes, zweites) if not MARKEN_PLATZHALTER_RE.search(w) and "#" not in w)
+                        normal.append((self.paare, marke, level))
+                        normal.append((self.paare, marke + ".", level))
+                        stern.append((self.paare, marke + "*", level))
+                    elif marke.endswith(")"):
+                        normal.append((self.praefixe, marke, level))
+                        stern.append((self.marken, marke + "*", level))
+                    else:
+                        normal.append((self.marken, marke, level))
+                        stern.append((self.marken, marke[:-1] + "*", level))
+        # Wie bisher: Sternchen-Formen zuerst, dann Ebene 1..n - der erste Eintrag gewinnt
+        for ziel, marke, level in stern:
+            ziel.setdefault(marke, (True, level))
+        for ziel, marke, level in normal:
+            ziel.setdefault(marke, (False, level))
+        self.paarwoerter |= {w + "*" for w in self.paarwoerter} | {w + "." for w in self.paarwoerter}
+
+        anfaenge = {m[0] for m in self.marken} | {m[0] for m in self.praefixe} | {m[0] for m in self.paare}
+        if "#" in anfaenge:
+            anfaenge |= set("0123456789")
+        self.anfaenge = frozenset(anfaenge)
+
+        # Ausgabe je Ebene: (Befehl, TOC-Befehl, TOC-Einzug, fett)
+        befehle = spec.get("befehle", GLIEDERUNG_BEFEHLE)
+        einzug = spec.get("einzug", GLIEDERUNG_EINZUG)
+        fett = set(spec.get("fett", (1,)))
+        self.ebenen = {
+            level: (befehle[level - 1], "subsubsection" if level >= 3 else befehle[level - 1].rstrip("*"),
+                    f"{einzug[level - 1]}em", level in fett)
+            for level in range(1, len(spec["ebenen"]) + 1)
         }
 
-        self.footnote_pattern = r'\\fn\((.*?)\)'
+    @staticmethod
+    def _expand(vorlage):
+        platzhalter = MARKEN_PLATZHALTER_RE.search(vorlage)
+        if platzhalter is None:
+            return [vorlage]
+        kopf, fuss = vorlage[:platzhalter.start()], vorlage[platzhalter.end():]
+        return [kopf + wert + fuss for wert in MARKEN_PLATZHALTER[platzhalter.group()]]
 
-    def parse_content(self, lines):
-        latex_output = []
+    def classify(self, line_s):
+        """(starred, level, match_end) für eine gestrippte, nicht leere Zeile oder None."""
+        if line_s[0] not in self.anfaenge:
+            return None
+        teile = line_s.split(None, 2)
+        wort = teile[0]
+        schluessel = ZIFFERN_RE.sub("#", wort)
+        if len(teile) > 1 and (wort in self.paarwoerter or teile[1] in self.paarwoerter):
+            treffer = self.paare.get(schluessel + " " + ZIFFERN_RE.sub("#", teile[1]))
+            if treffer is not None:
+                return treffer[0], treffer[1], line_s.index(teile[1], len(wort)) + len(teile[1])
+        treffer = self.marken.get(schluessel)
+        if treffer is not None:
+            return treffer[0], treffer[1], len(wort)
+        klammer = wort.find(")")
+        if klammer >= 0:
+            treffer = self.praefixe.get(ZIFFERN_RE.sub("#", wort[:klammer + 1]))
+            if treffer is not None:
+                return treffer[0], treffer[1], klammer + 1
+        return None
+
+@st.cache_resource
+def get_gliederungsschema(name):
+    """Kompiliert ein Schema einmal pro Prozess (die Tabellen werden nur gelesen)."""
+    return Gliederungsschema(name, GLIEDERUNGSSCHEMATA[name])
+
+# --- PARSER KLASSE ---
+class KlausurDocument:
+    def __init__(self, schema=GLIEDERUNG_STANDARD):
+        self.set_schema(schema)
+
+    def set_schema(self, schema):
+        """Wechselt das Gliederungsschema (ohne neuen Parser; kompiliert wird nur einmal)."""
+        self.schema = schema
+        self.gliederung = get_gliederungsschema(schema)
+
+    def classify(self, line_s):
+        """Ordnet eine (gestrippte) Zeile über das aktive Gliederungsschema ein.
+
+        Gibt (starred, level, match_end) zurück oder None für Fließtext.
+        """
+        return self.gliederung.classify(line_s)
+
+    def escape_latex(self, text):
+        """Entschärft LaTeX-Sonderzeichen und wandelt \\fn(...) in Fußnoten um - in einem Durchlauf.
+
+        Bewusst gesetzte Befehle (\\textbf, \\red, \\\\, bereits escapte Zeichen wie \\&)
+        sowie Klammern und ~ bleiben unverändert, ebenso das URL-Argument von \\url/\\href.
+        Fußnoten dürfen runde Klammern enthalten; ein nicht geschlossenes \\fn( bleibt
+        stehen (und wird von der Prüfung gemeldet).
+        """
+        match = ESCAPE_TOKEN_RE.search(text)
+        if match is None:
+            return text
+        out = []
+        pos = 0
+        n = len(text)
+        while match is not None:
+            out.append(text[pos:match.start()])
+            token = match.group()
+            pos = match.end()
+            if token == "\\fn(":
+                depth = 1
+                i = pos
+                while i < n:
+                    c = text[i]
+                    if c == "\\":
+                        i += 2
+                        continue
+                    if c == "(":
+                        depth += 1
+                    elif c == ")":
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    i += 1
+                if depth == 0 and i < n:
+                    out.append("\\footnote{" + self.escape_latex(text[pos:i]) + "}")
+                    pos = i + 1
+                else:
+                    out.append(token)
+            elif token in VERBATIM_ARG_COMMANDS and text.startswith("{", pos):
+                depth = 0
+                i = pos
+                while i < n:
+                    if text[i] == "{":
+                        depth += 1
+                    elif text[i] == "}":
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    i += 1
+                # Argument unverändert übernehmen; ohne schließende Klammer meldet es die Prüfung
+                out.append(token + text[pos:i + 1])
+                pos = i + 1
+            elif token[0] == "\\":
+                out.append(token)
+            else:
+                out.append(LATEX_ESCAPES[token])
+            match = ESCAPE_TOKEN_RE.search(text, pos)
+        out.append(text[pos:])
+        return "".join(out)
+
+    def translate_line(self, line):
+        """Übersetzt eine einzelne Editorzeile in LaTeX (ggf. mehrzeilig)."""
+        return self.translate_line_outline(line)[0]
+
+    def translate_line_outline(self, line):
+        """Wie translate_line, liefert aber zusätzlich die Gliederungsinfo der Zeile.
+
+        Rückgabe: (latex, heading) mit heading = (level, starred, bold, text) oder None.
+        """
+        line_s = line.strip()
+        if not line_s:
+            return "\\medskip", None
+
+        heading = self.classify(line_s)
+        if heading is None:
+            return self.escape_latex(line_s), None
+
+        raw_line = line_s
+
+        starred, level, match_end = heading
+        cmd, toc_cmd, toc_indent, ebene_fett = self.gliederung.ebenen[level]
+        # --- 1. BLOCK: Verarbeitung der Sternchen-Überschriften (Versteckte Gliederung) ---
+        if starred:
+            # Hier wird der Marker (z.B. "Teil 1*") abgeschnitten
+            display_text = line_s[match_end:].strip()
+
+            # Falls kein Text nach dem Sternchen folgt, nimm die Zeile ohne Stern
+            if not display_text:
+                display_text = line_s.replace('*', '').strip()
+
+            return f"\\{cmd}{{{self.escape_latex(display_text)}}}", (level, True, False, raw_line)
+
+        # --- 2. BLOCK: Verarbeitung der normalen Überschriften (In Gliederung) ---
+        # --- NEU: Prüfung auf manuelles Fett-Sternchen am Ende ---
+        # Wenn die Zeile auf * endet (z.B. "A. Diebstahl*")
+        manual_bold = False
+        if line_s.endswith('*'):
+            manual_bold = True
+            line_s = line_s[:-1].strip() # Sternchen für die Ausgabe entfernen
+
+        # --- FORMATIERUNG & EINRÜCKUNG (Befehl und TOC-Einzug kommen aus dem Schema) ---
+        # Wenn die Ebene laut Schema fett ist ODER das manuelle Sternchen gesetzt wurde -> FETT
+        bold = ebene_fett or manual_bold
+        if bold:
+            display_text = f"\\textbf{{{self.escape_latex(line_s)}}}"
+        else:
+            display_text = self.escape_latex(line_s)
+
+        # Ausgabe im Dokument + Eintrag ins Inhaltsverzeichnis (TOC)
+        return (f"\\{cmd}{{{display_text}}}\n"
+                f"\\addcontentsline{{toc}}{{{toc_cmd}}}{{\\hspace{{{toc_indent}}}{display_text}}}",
+                (level, False, bold, raw_line))
+
+    def iter_content(self, lines):
+        """Liefert die LaTeX-Übersetzung Zeile für Zeile (ohne Trennzeichen) als Generator."""
         for line in lines:
-            line_s = line.strip()
-            if not line_s:
-                latex_output.append("\\medskip")
+            yield self.translate_line(line)
+
+    def parse_content(self, lines):
+        return "\n".join(self.iter_content(lines))
+
+# --- DOKUMENTMODELL (TEXT EINMAL, ZEILEN ALS OFFSETS + KOMPAKTE ARRAYS) ---
+# Statt bei jedem Rerun mehrere Zeilenlisten per split('\n') zu erzeugen, hält das Modell
+# den Editortext einmal und pro Zeile nur Zahlen: Startoffset (array 'I'), Art, Ebene,
+# Flags (array 'B') und Wortzahl (array 'I'). Zeilentext entsteht erst bei Bedarf als Slice.
+ZEILE_LEER, ZEILE_TEXT, ZEILE_UEBERSCHRIFT = 0, 1, 2
+FLAG_STERN, FLAG_FETT = 1, 2
+
+def _common_prefix_len(a, b):
+    """Länge des gemeinsamen Anfangs; Binärsuche mit schrumpfenden Vergleichsfenstern (O(n))."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a.startswith(b[lo:mid], lo):
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _common_suffix_len(a, b, limit):
+    """Länge des gemeinsamen Endes, höchstens `limit` Zeichen."""
+    la, lb = len(a), len(b)
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a.endswith(b[lb - mid:lb - lo], 0, la - lo):
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+class DocumentModel:
+    """Editortext plus LaTeX-Übersetzung und Gliederungsinfo pro Zeile.
+
+    update() übersetzt nur die Zeilen zwischen gemeinsamem Anfang und gemeinsamem Ende
+    des alten und neuen Texts neu (ermittelt direkt auf dem String, ohne split).
+    `chunks` (LaTeX pro Zeile) wird bei Änderungen neu gebaut, nie nachträglich verändert,
+    und kann daher gefahrlos an Worker-Threads gehen.
+    """
+
+    def __init__(self):
+        self.schema = None
+        self.text = ""
+        self.starts = array('I', [0])
+        self.kinds = array('B', [ZEILE_LEER])
+        self.levels = array('B', [0])
+        self.flags = array('B', [0])
+        self.words = array('I', [0])
+        self.chunks = ["\\medskip"]
+        self._outline = None
+        self._word_count = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def line(self, nr):
+        """Text der Zeile `nr` (0-basiert) ohne Zeilenumbruch."""
+        start = self.starts[nr]
+        if nr + 1 < len(self.starts):
+            return self.text[start:self.starts[nr + 1] - 1]
+        return self.text[start:]
+
+    def update(self, text, parser):
+        """Gleicht das Modell mit `text` ab und gibt die LaTeX-Chunks zurück."""
+        if parser.schema != self.schema:
+            # Anderes Gliederungsschema: alle Zeilen neu einordnen
+            self.__init__()
+            self.schema = parser.schema
+        alt = self.text
+        if text == alt:
+            return self.chunks
+        la, lb = len(alt), len(text)
+        n_alt = len(self.starts)
+
+        prefix = _common_prefix_len(alt, text)
+        suffix = _common_suffix_len(alt, text, min(la, lb) - prefix)
+        # Erste betroffene Zeile: die, in der der Unterschied beginnt
+        kopf = bisect_right(self.starts, prefix) - 1
+        # Unveränderte Schlusszeilen: Zeilenanfang samt vorangehendem Umbruch im gemeinsamen Ende
+        fuss = n_alt - bisect_right(self.starts, la - suffix)
+        fuss = max(0, min(fuss, n_alt - kopf - 1))
+
+        anfang = self.starts[kopf]
+        if fuss:
+            ende = self.starts[n_alt - fuss] + (lb - la) - 1
+        else:
+            ende = lb
+        mitte_starts = []
+        mitte_chunks = []
+        mitte_kinds = []
+        mitte_levels = []
+        mitte_flags = []
+        mitte_words = []
+        pos = anfang
+        for zeile in text[anfang:ende].split('\n'):
+            mitte_starts.append(pos)
+            pos += len(zeile) + 1
+            chunk, heading = parser.translate_line_outline(zeile)
+            mitte_chunks.append(chunk)
+            mitte_words.append(len(zeile.split()))
+            if heading is not None:
+                level, starred, bold, _ = heading
+                mitte_kinds.append(ZEILE_UEBERSCHRIFT)
+                mitte_levels.append(level)
+                mitte_flags.append((FLAG_STERN if starred else 0) | (FLAG_FETT if bold else 0))
+            else:
+                mitte_kinds.append(ZEILE_TEXT if zeile.strip() else ZEILE_LEER)
+                mitte_levels.append(0)
+                mitte_flags.append(0)
+
+        delta = lb - la
+        rest = n_alt - fuss
+        self.starts[kopf:] = array('I', mitte_starts) + array('I', (s + delta for s in self.starts[rest:]))
+        self.kinds[kopf:rest] = array('B', mitte_kinds)
+        self.levels[kopf:rest] = array('B', mitte_levels)
+        self.flags[kopf:rest] = array('B', mitte_flags)
+        self.words[kopf:rest] = array('I', mitte_words)
+        self.chunks = self.chunks[:kopf] + mitte_chunks + self.chunks[rest:]
+        self.text = text
+        self._outline = None
+        self._word_count = None
+        return self.chunks
+
+    def outline(self):
+        """Liste von OutlineEntry(line, level, starred, bold, text); `line` ist 0-basiert."""
+        if self._outline is None:
+            kinds, levels, flags = self.kinds, self.levels, self.flags
+            self._outline = [
+                OutlineEntry(nr, levels[nr], bool(flags[nr] & FLAG_STERN), bool(flags[nr] & FLAG_FETT),
+                             self.line(nr).strip())
+                for nr in range(len(kinds)) if kinds[nr] == ZEILE_UEBERSCHRIFT
+            ]
+        return self._outline
+
+    @property
+    def char_count(self):
+        return len(self.text)
+
+    @property
+    def word_count(self):
+        if self._word_count is None:
+            self._word_count = sum(self.words)
+        return self._word_count
+
+# --- VORAB-PRÜFUNG (LINT) VOR DEM PDFLATEX-LAUF ---
+# Befehle, die die Vorlage/der Parser bereitstellen oder die in jedem LaTeX-Kern vorhanden sind.
+KNOWN_COMMANDS = frozenset("""
+    textbf textit textsc texttt textsf textrm textsuperscript textsubscript emph underline
+    red blue green color textcolor
+    vspace hspace medskip bigskip smallskip noindent par newline linebreak pagebreak newpage clearpage
+    footnote section subsection subsubsection paragraph subparagraph addcontentsline
+    tiny scriptsize footnotesize small normalsize large Large LARGE huge Huge
+    centering raggedright raggedleft begin end item quad qquad enspace
+    S P ldots dots dash today LaTeX TeX glqq grqq glq grq flqq frqq
+    url href hyphenation mbox fbox makebox nolinebreak nopagebreak setstretch singlespacing onehalfspacing doublespacing
+""".split())
+KNOWN_ENVIRONMENTS = frozenset(
+    "itemize enumerate description center flushleft flushright quote quotation minipage tabular".split()
+)
+LINT_TOKEN_RE = re.compile(r"\\(?:([A-Za-z@]+)|.)|[{}]")
+LINT_ENV_RE = re.compile(r"\{([^{}]*)\}")
+
+LintIssue = namedtuple("LintIssue", ["line", "severity", "message"])
+
+def lint_latex(body_chunks):
+    """Prüft die geparsten Zeilen auf typische Fehler, bevor pdflatex startet.
+
+    `body_chunks` ist die LaTeX-Übersetzung pro Editorzeile (siehe DocumentModel.chunks),
+    Zeilennummern im Ergebnis beziehen sich daher direkt auf den Editor (1-basiert).
+    Fehler ("error") verhindern den Kompiliervorgang, Hinweise ("warning") nicht.
+    """
+    issues = []
+    offene_klammern = []   # Zeilennummern offener {
+    umgebungen = []        # (Name, Zeilennummer)
+    for nr, chunk in enumerate(body_chunks, start=1):
+        if "\\" not in chunk and "{" not in chunk and "}" not in chunk:
+            continue
+        for match in LINT_TOKEN_RE.finditer(chunk):
+            token = match.group()
+            if token == "{":
+                offene_klammern.append(nr)
+            elif token == "}":
+                if offene_klammern:
+                    offene_klammern.pop()
+                else:
+                    issues.append(LintIssue(nr, "error", "Schließende Klammer } ohne passende öffnende Klammer."))
+            else:
+                name = match.group(1)
+                if name is None:
+                    continue
+                if name == "fn":
+                    issues.append(LintIssue(nr, "error", "Fußnote \\fn( wird nicht mit ) geschlossen."))
+                elif name in ("begin", "end"):
+                    env = LINT_ENV_RE.match(chunk, match.end())
+                    env_name = env.group(1) if env else ""
+                    if env_name not in KNOWN_ENVIRONMENTS:
+                        issues.append(LintIssue(nr, "warning", f"Unbekannte Umgebung '{env_name}'."))
+                    if name == "begin":
+                        umgebungen.append((env_name, nr))
+                    elif not umgebungen:
+                        issues.append(LintIssue(nr, "error", f"\\end{{{env_name}}} ohne passendes \\begin."))
+                    else:
+                        offen, offen_nr = umgebungen.pop()
+                        if offen != env_name:
+                            issues.append(LintIssue(nr, "error", f"\\end{{{env_name}}} schließt \\begin{{{offen}}} aus Zeile {offen_nr}."))
+                elif name not in KNOWN_COMMANDS:
+                    issues.append(LintIssue(nr, "warning", f"Unbekannter Befehl \\{name}."))
+    for nr in offene_klammern:
+        issues.append(LintIssue(nr, "error", "Öffnende Klammer { wird nicht geschlossen."))
+    for env_name, nr in umgebungen:
+        issues.append(LintIssue(nr, "error", f"\\begin{{{env_name}}} wird nicht mit \\end{{{env_name}}} geschlossen."))
+    # Überschriften enthalten den Text zweimal (Befehl + \addcontentsline): jede Meldung nur einmal
+    issues = list(dict.fromkeys(issues))
+    issues.sort(key=lambda issue: issue.line)
+    return issues
+
+# --- LATEX-VORLAGE (EINMAL ZENTRAL, GECACHT) ---
+# Trennmarke zwischen festem (vorkompilierbarem) und dokumentabhängigem Teil der Präambel
+ENDOFDUMP = r"\csname endofdump\endcsname"
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_latex_document(text, kl_titel, kl_datum, kl_kuerzel, rand_wert, zeilenabstand,
+                         selected_font_package, sachverhalt_cmd="", schema=GLIEDERUNG_STANDARD):
+    """Baut den vollständigen LaTeX-Quelltext (Präambel + Gutachten).
+
+    Über st.cache_data sessionübergreifend memoisiert (LRU, max. 64 Einträge):
+    Bei unveränderten Eingaben wird weder neu geparst noch neu zusammengesetzt.
+    Bewusst ohne Parser/Dokumentmodell der Session: alles Ergebnisrelevante steckt in den
+    gehashten Argumenten, sonst könnte ein Eintrag für andere Sessions falsch sein.
+    """
+    with timed("parse"):
+        parsed_content = KlausurDocument(schema).parse_content(text.split('\n'))
+
+    with timed("tex_assembly"):
+        head, tail = latex_document_frame(kl_titel, kl_datum, kl_kuerzel, rand_wert, zeilenabstand,
+                                          selected_font_package, sachverhalt_cmd)
+        return head + parsed_content + tail
+
+def iter_latex_chunks(head, body_chunks, tail):
+    """Streamt Präambel, Gutachten (zeilenweise) und Schluss, ohne alles zusammenzufügen.
+
+    "".join(...) ergibt exakt dasselbe wie build_latex_document.
+    """
+    yield head
+    for i, chunk in enumerate(body_chunks):
+        if i:
+            yield "\n"
+        yield chunk
+    yield tail
+
+def build_line_map(body_chunks, first_line=1):
+    """Zeilenzuordnung .tex -> Editor: Eintrag k = Editorzeile (1-basiert) der k-ten Gutachtenzeile.
+
+    Eine Editorzeile kann mehrere .tex-Zeilen erzeugen (Überschrift + TOC-Eintrag).
+    `first_line` ist die Editorzeile des ersten Chunks (für Ausschnitte).
+    """
+    line_map = []
+    for nr, chunk in enumerate(body_chunks, start=first_line):
+        line_map.extend([nr] * (chunk.count("\n") + 1))
+    return line_map
+
+def latex_document_frame(kl_titel, kl_datum, kl_kuerzel, rand_wert, zeilenabstand,
+                         selected_font_package, sachverhalt_cmd="", vorschau=False):
+    """Liefert (Kopf, Schluss) des Dokuments; dazwischen gehört der geparste Gutachtentext.
+
+    Alles vor ENDOFDUMP hängt nur von der Schriftart ab und wird als Format vorkompiliert.
+    Mit `vorschau=True` entfallen Sachverhalt und Gliederungsseite (ein Lauf genügt).
+    """
+    if vorschau:
+        sachverhalt_cmd = ""
+        gliederung = ""
+    else:
+        gliederung = r"""\pagenumbering{gobble}
+\tableofcontents\clearpage
+"""
+    if kl_datum.strip():
+        titel_komp = f"{kl_titel} ({kl_datum})"
+    else:
+        titel_komp = kl_titel
+
+    font_latex = f"\\usepackage{{{selected_font_package}}}"
+    if "helvet" in selected_font_package:
+        font_latex += "\n\\renewcommand{\\familydefault}{\\sfdefault}"
+
+    head = r"""\documentclass[12pt, a4paper, oneside]{jurabook}
+\usepackage[ngerman]{babel}
+\usepackage[utf8]{inputenc}
+\usepackage[T1]{fontenc}
+\usepackage{pdfpages}
+\usepackage[hidelinks]{hyperref}
+\usepackage{xurl}
+\usepackage{xcolor}
+
+% --- Textfarben mir Alias ---
+\definecolor{myRed}{RGB}{190, 20, 20}
+\definecolor{myBlue}{RGB}{0, 80, 160}
+\definecolor{myGreen}{RGB}{0, 120, 50}
+
+\newcommand{\red}[1]{{\color{myRed}#1}}
+\newcommand{\blue}[1]{{\color{myBlue}#1}}
+\newcommand{\green}[1]{{\color{myGreen}#1}}
+
+\addto\captionsngerman{\renewcommand{\contentsname}{Gliederung}}
+
+""" + font_latex + r"""
+\usepackage{setspace}
+\usepackage{geometry}
+\usepackage{fancyhdr}
+% --- Ende des festen Teils: bis hierher steckt alles im vorkompilierten Format ---
+""" + ENDOFDUMP + r"""
+\geometry{left=2cm, right=2cm, top=2.5cm, bottom=3cm}
+\setcounter{tocdepth}{8}
+\setcounter{secnumdepth}{8}
+\setlength{\parindent}{0pt}
+
+\fancypagestyle{iustwrite}{
+    \fancyhf{}
+    \fancyhead[L]{\small """ + kl_kuerzel + r"""}
+    \fancyhead[R]{\small """ + titel_komp + r"""}
+    \fancyfoot[R]{\thepage}
+    \renewcommand{\headrulewidth}{0.5pt}
+    \fancyhfoffset[R]{0pt}
+}
+\begin{document}
+\sloppy
+""" + sachverhalt_cmd + r"""
+""" + gliederung + r"""\newgeometry{left=2cm, right=""" + rand_wert + r""", top=2.5cm, bottom=3cm}
+\pagenumbering{arabic}
+\setcounter{page}{1}
+\pagestyle{iustwrite}\setstretch{""" + zeilenabstand + r"""}
+{\noindent\Large\bfseries """ + titel_komp + r""" \par}\bigskip
+"""
+    tail = r"""
+\end{document}"""
+    return head, tail
+
+# --- METRIKEN (LAUFZEIT JE STUFE, ZÄHLER) ---
+# Nur mit IUSTWRITE_METRICS=1 aktiv. Abgeschaltet liefert timed() einen geteilten
+# No-op-Kontext und count_event() kehrt sofort zurück. Quantile (p50/p95/p99) kommen
+# aus einem Ringpuffer der letzten Messungen je Stufe. Ausgabe alle
+# METRICS_DUMP_INTERVAL_S Sekunden als Prometheus-Textdatei (IUSTWRITE_METRICS_FILE,
+# z.B. für den node_exporter-Textfile-Collector) oder sonst als Logzeile (Logger "iustwrite").
+METRICS_ENABLED = os.environ.get("IUSTWRITE_METRICS", "0") == "1"
+METRICS_FILE = os.environ.get("IUSTWRITE_METRICS_FILE", "")
+METRICS_DUMP_INTERVAL_S = 15
+METRICS_WINDOW = 1024
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+# Debug-Panel in der Sidebar nur mit ?admin=<Token> in der URL
+METRICS_ADMIN_TOKEN = os.environ.get("IUSTWRITE_ADMIN_TOKEN", "")
+
+class MetricsRegistry:
+    """Prozessweite Sammelstelle für Stufen-Laufzeiten und Ereigniszähler (threadsicher)."""
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}   # Stufe -> deque der letzten Laufzeiten (Sekunden)
+        self.totals = {}    # Stufe -> [Anzahl, Summe] seit Prozessstart
+        self.counters = {}
+        self.last_dump = time.monotonic()
+        self.dump_lock = threading.Lock()  # eine Ausgabe gleichzeitig (gemeinsame .tmp-Datei)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            werte = self.samples.get(stage)
+            if werte is None:
+                werte = self.samples[stage] = deque(maxlen=self.window)
+                self.totals[stage] = [0, 0.0]
+            werte.append(seconds)
+            summe = self.totals[stage]
+            summe[0] += 1
+            summe[1] += seconds
+        self.maybe_dump()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        self.maybe_dump()
+
+    def snapshot(self):
+        """({Stufe: {"count", "sum", "p50", "p95", "p99"}}, {Zähler: Wert})"""
+        with self.lock:
+            roh = {stage: (sorted(werte), tuple(self.totals[stage])) for stage, werte in self.samples.items()}
+            counters = dict(self.counters)
+        stages = {}
+        for stage, (werte, (anzahl, summe)) in sorted(roh.items()):
+            eintrag = {"count": anzahl, "sum": summe}
+            for q in METRICS_QUANTILES:
+                eintrag[f"p{int(q * 100)}"] = werte[int(q * (len(werte) - 1))]
+            stages[stage] = eintrag
+        return stages, dict(sorted(counters.items()))
+
+    def render_prometheus(self):
+        stages, counters = self.snapshot()
+        zeilen = ["# TYPE iustwrite_stage_seconds summary"]
+        for stage, eintrag in stages.items():
+            for q in METRICS_QUANTILES:
+                zeilen.append(f'iustwrite_stage_seconds{{stage="{stage}",quantile="{q}"}} {eintrag[f"p{int(q * 100)}"]:.6f}')
+            zeilen.append(f'iustwrite_stage_seconds_sum{{stage="{stage}"}} {eintrag["sum"]:.6f}')
+            zeilen.append(f'iustwrite_stage_seconds_count{{stage="{stage}"}} {eintrag["count"]}')
+        for name, wert in counters.items():
+            zeilen.append(f"# TYPE iustwrite_{name}_total counter")
+            zeilen.append(f"iustwrite_{name}_total {wert}")
+        return "\n".join(zeilen) + "\n"
+
+    def maybe_dump(self):
+        jetzt = time.monotonic()
+        with self.lock:
+            if jetzt - self.last_dump < METRICS_DUMP_INTERVAL_S:
+                return
+            self.last_dump = jetzt
+        with self.dump_lock:
+            if METRICS_FILE:
+                try:
+                    tmp = f"{METRICS_FILE}.{os.getpid()}.tmp"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.write(self.render_prometheus())
+                    os.replace(tmp, METRICS_FILE)
+                except OSError:
+                    pass
+            else:
+                stages, counters = self.snapshot()
+                logger.info("metrics %s", json.dumps({"stages": stages, "counters": counters}))
+
+@st.cache_resource
+def get_metrics_registry():
+    return MetricsRegistry()
+
+# Über Reruns hinweg dieselbe Instanz (cache_resource), auch für Worker-Threads
+METRICS = get_metrics_registry()
+
+class _StageTimer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        METRICS.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+_NO_TIMER = contextlib.nullcontext()
+
+def timed(stage):
+    """`with timed("parse"): ...` misst die Stufe - abgeschaltet praktisch kostenlos."""
+    if not METRICS_ENABLED:
+        return _NO_TIMER
+    return _StageTimer(stage)
+
+def observe_duration(stage, seconds):
+    """Für bereits gemessene Laufzeiten (z.B. die Metriken aus run_sandboxed)."""
+    if METRICS_ENABLED:
+        METRICS.observe(stage, seconds)
+
+def count_event(name, n=1):
+    if METRICS_ENABLED:
+        METRICS.count(name, n)
+
+# --- PDF-CACHE (INHALTSADRESSIERT, GRÖSSENBEGRENZT) ---
+# Schlüssel = SHA-256 über finalen LaTeX-Code, Sachverhalt-PDF und Asset-Stand.
+# Zugriffszeit = mtime der Datei; beim Überschreiten der Größe fliegen die ältesten raus (LRU).
+PDF_CACHE_DIR = Path(os.environ.get("IUSTWRITE_PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), "iustwrite_pdf_cache")))
+PDF_CACHE_MAX_BYTES = int(os.environ.get("IUSTWRITE_PDF_CACHE_MB", "200")) * 1024 * 1024
+
+def asset_fingerprint(assets_folder):
+    """Versionsstempel der LaTeX-Assets (Name, Größe, mtime) - ändert sich bei jedem Update."""
+    teile = []
+    if os.path.isdir(assets_folder):
+        for item in sorted(os.listdir(assets_folder)):
+            s = os.stat(os.path.join(assets_folder, item))
+            teile.append(f"{item}:{s.st_size}:{s.st_mtime_ns}")
+    return "|".join(teile)
+
+def pdf_cache_key(latex_parts, sachverhalt_id, assets_version):
+    """`latex_parts` ist ein Iterable von Textstücken (z.B. aus iter_latex_chunks),
+    `sachverhalt_id` der Inhalts-Hash des Sachverhalt-PDFs (plus Modus) oder None."""
+    h = hashlib.sha256()
+    for part in latex_parts:
+        h.update(part.encode("utf-8"))
+    h.update(b"\0")
+    h.update((sachverhalt_id or "").encode("utf-8"))
+    h.update(b"\0")
+    h.update(assets_version.encode("utf-8"))
+    return h.hexdigest()
+
+def pdf_cache_get(key):
+    if PDF_CACHE_MAX_BYTES <= 0:
+        return None
+    pfad = PDF_CACHE_DIR / f"{key}.pdf"
+    try:
+        data = pfad.read_bytes()
+    except OSError:
+        count_event("pdf_cache_misses")
+        return None
+    count_event("pdf_cache_hits")
+    try:
+        os.utime(pfad)  # als "zuletzt benutzt" markieren
+    except OSError:
+        pass
+    return data
+
+def pdf_cache_put(key, data):
+    if PDF_CACHE_MAX_BYTES <= 0 or len(data) > PDF_CACHE_MAX_BYTES:
+        return
+    try:
+        PDF_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Atomar schreiben, damit parallele Sessions nie eine halbe Datei lesen
+        tmp = PDF_CACHE_DIR / f"{key}.{os.getpid()}.tmp"
+        tmp.write_bytes(data)
+        os.replace(tmp, PDF_CACHE_DIR / f"{key}.pdf")
+        _pdf_cache_evict()
+    except OSError:
+        pass
+
+def _pdf_cache_evict():
+    eintraege = []
+    for pfad in PDF_CACHE_DIR.glob("*.pdf"):
+        try:
+            s = pfad.stat()
+        except OSError:
+            continue
+        eintraege.append((s.st_mtime, s.st_size, pfad))
+    gesamt = sum(e[1] for e in eintraege)
+    for _, size, pfad in sorted(eintraege):
+        if gesamt <= PDF_CACHE_MAX_BYTES:
+            break
+        try:
+            pfad.unlink()
+            gesamt -= size
+        except OSError:
+            pass
+
+# --- SANDBOX FÜR PDFLATEX (TIMEOUT, RLIMITS, ABBRUCH, METRIKEN) ---
+PDFLATEX_TIMEOUT_S = float(os.environ.get("IUSTWRITE_PDFLATEX_TIMEOUT_S", "60"))
+PDFLATEX_CPU_S = int(os.environ.get("IUSTWRITE_PDFLATEX_CPU_S", "60"))
+PDFLATEX_MEM_MB = int(os.environ.get("IUSTWRITE_PDFLATEX_MEM_MB", "1536"))
+PDFLATEX_FSIZE_MB = int(os.environ.get("IUSTWRITE_PDFLATEX_FSIZE_MB", "200"))
+_POLL_S = 0.02
+
+def _apply_rlimits(pid):
+    """Begrenzt CPU-Zeit, Adressraum und Dateigröße des Kindprozesses (nur wo verfügbar)."""
+    try:
+        import resource
+        resource.prlimit(pid, resource.RLIMIT_CPU, (PDFLATEX_CPU_S, PDFLATEX_CPU_S + 5))
+        resource.prlimit(pid, resource.RLIMIT_AS, (PDFLATEX_MEM_MB * 1024 * 1024,) * 2)
+        resource.prlimit(pid, resource.RLIMIT_FSIZE, (PDFLATEX_FSIZE_MB * 1024 * 1024,) * 2)
+    except (ImportError, AttributeError, OSError, ValueError):
+        pass
+
+def run_sandboxed(cmd, cwd, env, timeout=PDFLATEX_TIMEOUT_S, cancel_event=None):
+    """Startet `cmd` in eigener Prozessgruppe mit Ressourcenlimits.
+
+    Bei Zeitüberschreitung oder gesetztem `cancel_event` wird die ganze Gruppe mit
+    SIGKILL beendet. Gibt (CompletedProcess, Metriken) zurück; die Metriken enthalten
+    Dauer, Abbruchgrund ("ok", "error", "timeout", "cancelled", "signal") und Peak-RSS.
+    """
+    start = time.monotonic()
+    with tempfile.TemporaryFile(dir=cwd) as out:
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=out, stderr=subprocess.STDOUT,
+                                stdin=subprocess.DEVNULL, start_new_session=True)
+        _apply_rlimits(proc.pid)
+        exit_reason = None
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            if cancel_event is not None and cancel_event.is_set():
+                exit_reason = "cancelled"
+            elif time.monotonic() - start > timeout:
+                exit_reason = "timeout"
+            if exit_reason:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                pid, status, rusage = os.wait4(proc.pid, 0)
+                break
+            time.sleep(_POLL_S)
+        returncode = os.waitstatus_to_exitcode(status)
+        proc.returncode = returncode
+        out.seek(0)
+        stdout = out.read()
+
+    if exit_reason is None:
+        if returncode == 0:
+            exit_reason = "ok"
+        elif returncode < 0:
+            exit_reason = "signal"  # z.B. SIGXCPU durch das CPU-Limit
+        else:
+            exit_reason = "error"
+    metrics = {
+        "cmd": os.path.basename(cmd[0]),
+        "duration_s": round(time.monotonic() - start, 3),
+        "exit_reason": exit_reason,
+        "returncode": returncode,
+        "peak_rss_kb": rusage.ru_maxrss,
+    }
+    logger.info("compile %s", json.dumps(metrics))
+    return subprocess.CompletedProcess(cmd, returncode, stdout), metrics
+
+# --- VORKOMPILIERTES PRÄAMBEL-FORMAT (mylatexformat) ---
+# Der feste Teil der Präambel (Klasse + Pakete, je Schriftart verschieden) wird einmal als
+# .fmt gedumpt. Spätere Läufe starten von diesem Format und überspringen den festen Teil bis
+# \endofdump. Ohne Format ist \csname endofdump\endcsname ein harmloses \relax.
+FMT_CACHE_DIR = Path(os.environ.get("IUSTWRITE_FMT_DIR", os.path.join(tempfile.gettempdir(), "iustwrite_fmt")))
+
+class FormatBuildState:
+    """Sperre und fehlgeschlagene Formate - prozessweit, nicht pro Rerun neu."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failed = set()
+
+@st.cache_resource
+def get_format_build_state():
+    return FormatBuildState()
+
+# Wie METRICS: dieselbe Instanz über alle Reruns und Sessions (auch in Worker-Threads)
+FMT_STATE = get_format_build_state()
+
+def ensure_preamble_format(head, assets_folder):
+    """Liefert den Namen eines passenden .fmt (und baut es bei Bedarf) oder None.
+
+    `head` ist der Dokumentkopf (oder der ganze Quelltext) inklusive ENDOFDUMP-Marke.
+    """
+    idx = head.find(ENDOFDUMP)
+    pdflatex_bin = shutil.which("pdflatex")
+    if idx < 0 or pdflatex_bin is None:
+        return None
+    static_preamble = head[:idx]
+    h = hashlib.sha256()
+    h.update(static_preamble.encode("utf-8"))
+    h.update(asset_fingerprint(assets_folder).encode("utf-8"))
+    # Neue TeX-Installation -> altes Format unbrauchbar
+    h.update(str(os.stat(pdflatex_bin).st_mtime_ns).encode("utf-8"))
+    name = "iustwrite_" + h.hexdigest()[:16]
+    fmt_path = FMT_CACHE_DIR / f"{name}.fmt"
+    if fmt_path.exists():
+        return name
+
+    with FMT_STATE.lock:
+        if fmt_path.exists():
+            return name
+        if name in FMT_STATE.failed:
+            return None
+        with timed("preamble_format"), tempfile.TemporaryDirectory() as tmpdirname:
+            tmp_path = Path(tmpdirname)
+            with open(tmp_path / f"{name}.tex", "w", encoding="utf-8") as f:
+                f.write(static_preamble + ENDOFDUMP + "\n\\begin{document}\n\\end{document}\n")
+            env = os.environ.copy()
+            env["TEXINPUTS"] = f".:{assets_folder}:"
+            run_sandboxed(
+                ["pdflatex", "-ini", "-interaction=nonstopmode", f"-jobname={name}",
+                 "&pdflatex", "mylatexformat.ltx", f"{name}.tex"],
+                cwd=tmpdirname, env=env
+            )
+            built = tmp_path / f"{name}.fmt"
+            if not built.exists():
+                FMT_STATE.failed.add(name)
+                return None
+            try:
+                FMT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                # Eindeutiger Name: mehrere Prozesse (z.B. batch.py) können gleichzeitig bauen
+                fd, tmp_fmt = tempfile.mkstemp(prefix=f"{name}.", suffix=".tmp", dir=FMT_CACHE_DIR)
+                with os.fdopen(fd, "wb") as ziel, open(built, "rb") as quelle:
+                    shutil.copyfileobj(quelle, ziel)
+                os.replace(tmp_fmt, fmt_path)
+            except OSError:
+                return None
+    return name
+
+# --- BUILD-DRIVER (ADAPTIVE PDFLATEX-LÄUFE) ---
+# Dateien, deren Inhalt über einen weiteren Lauf entscheidet (Gliederung, Verweise, Lesezeichen)
+AUX_ENDUNGEN = (".aux", ".toc", ".out")
+RERUN_PATTERN = re.compile(rb"Rerun to get|Label\(s\) may have changed|Rerun LaTeX")
+
+def _aux_snapshot(workdir, jobname):
+    snapshot = {}
+    for endung in AUX_ENDUNGEN:
+        pfad = workdir / f"{jobname}{endung}"
+        if pfad.exists():
+            snapshot[endung] = pfad.read_bytes()
+    return snapshot
+
+def run_pdflatex(workdir, env, jobname="klausur", warm_aux=None, max_passes=3, fmt=None, cancel_event=None,
+                 timeout=PDFLATEX_TIMEOUT_S):
+    """Kompiliert so oft wie nötig statt pauschal zweimal.
+
+    Ein weiterer Lauf erfolgt nur, wenn sich .aux/.toc/.out geändert haben oder das Log
+    ausdrücklich "Rerun ..." verlangt. `warm_aux` (Dateiinhalte eines früheren Builds
+    derselben Session) wird vorab eingespielt, sodass oft ein einziger Lauf genügt.
+    Mit `fmt` startet pdflatex vom vorkompilierten Präambel-Format (siehe ensure_preamble_format).
+    Jeder Lauf läuft über run_sandboxed (mit `timeout` Sekunden); Timeout oder Abbruch
+    beenden die Schleife.
+    Gibt (letztes subprocess-Ergebnis, Anzahl Läufe, neuer Aux-Snapshot, Metriken je Lauf) zurück.
+    """
+    cmd = ["pdflatex", "-interaction=nonstopmode", "-file-line-error"]
+    if fmt:
+        cmd.append(f"-fmt={fmt}")
+    cmd.append(f"{jobname}.tex")
+
+    workdir = Path(workdir)
+    for endung, data in (warm_aux or {}).items():
+        (workdir / f"{jobname}{endung}").write_bytes(data)
+
+    vorher = _aux_snapshot(workdir, jobname)
+    result = None
+    passes = 0
+    metrics = []
+    while passes < max_passes:
+        result, run_metrics = run_sandboxed(cmd, cwd=workdir, env=env, timeout=timeout, cancel_event=cancel_event)
+        metrics.append(run_metrics)
+        observe_duration("pdflatex_pass", run_metrics["duration_s"])
+        passes += 1
+        if run_metrics["exit_reason"] in ("timeout", "cancelled", "signal"):
+            break
+        nachher = _aux_snapshot(workdir, jobname)
+        if result.returncode != 0 and not (workdir / f"{jobname}.pdf").exists():
+            break
+        if nachher == vorher and not RERUN_PATTERN.search(result.stdout or b""):
+            break
+        vorher = nachher
+    return result, passes, vorher, metrics
+
+# --- PDFLATEX-LOG AUSWERTEN (FEHLER/WARNUNGEN MIT EDITORZEILE) ---
+LOG_FILE_ERROR_RE = re.compile(r"^(?:\./)?(?P<file>[^:\s]+\.\w+):(?P<line>\d+): (?P<msg>.*)$")
+LOG_BOX_RE = re.compile(r"^(?P<msg>(?:Over|Under)full \\[hv]box \([^)]*\)).*?lines? (?P<line>\d+)")
+LOG_WARNING_RE = re.compile(r"^(?P<msg>(?:LaTeX|Package \S+) Warning: .*?)(?: on input line (?P<line>\d+)\.)?$")
+LOG_L_LINE_RE = re.compile(r"^l\.(?P<line>\d+)")
+
+LogMessage = namedtuple("LogMessage", ["severity", "tex_line", "editor_line", "message"])
+
+def parse_pdflatex_log(log_lines, head_lines, line_map, jobname="klausur"):
+    """Liest das Log zeilenweise (Iterable von bytes/str) in einem Durchgang.
+
+    Jede Logzeile wird über ihr Anfangszeichen genau einem Muster zugeordnet; die
+    Editorzeile ergibt sich per Listenindex aus `line_map` (siehe build_line_map),
+    `head_lines` ist die Zeilenzahl des Dokumentkopfs vor dem Gutachten.
+    """
+    def editor_line(tex_line):
+        if tex_line is None:
+            return None
+        k = tex_line - head_lines - 1
+        if 0 <= k < len(line_map):
+            return line_map[k]
+        return None
+
+    messages = []
+    pending_error = None
+    for raw in log_lines:
+        line = raw.decode("utf-8", errors="replace") if isinstance(raw, bytes) else raw
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        first = line[0]
+        if first == "!":
+            pending_error = line[1:].strip()
+            continue
+        if first == "l" and pending_error is not None:
+            m = LOG_L_LINE_RE.match(line)
+            if m:
+                tex_line = int(m.group("line"))
+                messages.append(LogMessage("error", tex_line, editor_line(tex_line), pending_error))
+                pending_error = None
+            continue
+        if first in "OU":
+            m = LOG_BOX_RE.match(line)
+            if m:
+                tex_line = int(m.group("line"))
+                messages.append(LogMessage("warning", tex_line, editor_line(tex_line), m.group("msg")))
+            continue
+        if first in "LP":
+            m = LOG_WARNING_RE.match(line)
+            if m:
+                tex_line = int(m.group("line")) if m.group("line") else None
+                messages.append(LogMessage("warning", tex_line, editor_line(tex_line), m.group("msg")))
+            continue
+        if ":" in line:
+            m = LOG_FILE_ERROR_RE.match(line)
+            if m:
+                tex_line = int(m.group("line"))
+                if m.group("file") != f"{jobname}.tex":
+                    messages.append(LogMessage("error", None, None, f"{m.group('file')}: {m.group('msg')}"))
+                else:
+                    messages.append(LogMessage("error", tex_line, editor_line(tex_line), m.group("msg")))
+    if pending_error is not None:
+        messages.append(LogMessage("error", None, None, pending_error))
+    return messages
+
+def format_log_message(msg):
+    if msg.editor_line is not None:
+        return f"Zeile {msg.editor_line}: {msg.message}"
+    if msg.tex_line is not None:
+        return f"Vorlage (.tex-Zeile {msg.tex_line}): {msg.message}"
+    return msg.message
+
+# --- SACHVERHALT-ABLAGE (INHALTSADRESSIERT, EINMAL PRO UPLOAD) ---
+# Hochgeladene Sachverhalte werden genau einmal unter ihrem SHA-256 abgelegt; Sessions und
+# Builds erhalten nur Hardlinks darauf, statt die Datei bei jedem Klick neu zu schreiben.
+# Die Linkanzahl dient als Referenzzähler der gemeinsam genutzten Datei.
+SV_STORE_DIR = Path(os.environ.get("IUSTWRITE_SV_DIR", os.path.join(tempfile.gettempdir(), "iustwrite_sv")))
+SV_STORE_MAX_AGE_S = int(os.environ.get("IUSTWRITE_SV_MAX_AGE_S", str(6 * 3600)))
+
+def store_sachverhalt(uploaded_file):
+    """Legt das PDF ab (falls noch nicht vorhanden) und gibt (sha256, Pfad) zurück.
+
+    Der Pfad ist ein eigener Hardlink der Session auf die gemeinsame Datei <sha>.pdf.
+    """
+    buffer = uploaded_file.getbuffer()  # memoryview, keine Kopie
+    sha = hashlib.sha256(buffer).hexdigest()
+    pfad = SV_STORE_DIR / f"{sha}.pdf"
+    SV_STORE_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        os.utime(pfad)
+    except FileNotFoundError:
+        tmp = SV_STORE_DIR / f"{sha}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(buffer)
+        os.replace(tmp, pfad)
+    session_pfad = SV_STORE_DIR / f"{sha}.{uuid.uuid4().hex}.pdf"
+    link_sachverhalt(pfad, session_pfad)
+    purge_sachverhalte()
+    return sha, session_pfad
+
+def purge_sachverhalte():
+    """Löscht Sachverhalte, die seit SV_STORE_MAX_AGE_S nicht mehr verwendet wurden."""
+    grenze = time.time() - SV_STORE_MAX_AGE_S
+    for alt in SV_STORE_DIR.glob("*.pdf"):
+        try:
+            if alt.stat().st_mtime < grenze:
+                alt.unlink()
+        except OSError:
+            pass
+
+def discard_sachverhalt(sachverhalt_path):
+    """Entfernt den Link der Session, sobald sie den Upload verwirft. Die gemeinsame Datei
+    fällt erst weg, wenn keine andere Session und kein laufender Build mehr darauf verweist."""
+    sachverhalt_path = Path(sachverhalt_path)
+    gemeinsam = SV_STORE_DIR / f"{sachverhalt_path.name.split('.', 1)[0]}.pdf"
+    try:
+        sachverhalt_path.unlink()
+        if gemeinsam.stat().st_nlink == 1:
+            gemeinsam.unlink()
+    except OSError:
+        pass
+    purge_sachverhalte()
+
+def link_sachverhalt(sachverhalt_path, ziel):
+    """Stellt den Sachverhalt unter `ziel` bereit (Hardlink, sonst Kopie). Beides bleibt
+    lesbar, auch wenn die Ablage währenddessen gelöscht wird."""
+    try:
+        os.link(sachverhalt_path, ziel)
+    except OSError:
+        shutil.copy(sachverhalt_path, ziel)
+
+def merge_sachverhalt(sachverhalt_path, pdf_bytes):
+    """Stellt den Sachverhalt dem fertigen Gutachten per PDF-Zusammenfügen voran
+    (statt \\includepdf im LaTeX-Lauf). Gibt None zurück, wenn pymupdf fehlt."""
+    try:
+        import pymupdf
+    except ImportError:
+        return None
+    with pymupdf.open(sachverhalt_path) as sv, pymupdf.open(stream=pdf_bytes, filetype="pdf") as gutachten:
+        sv.insert_pdf(gutachten)
+        return sv.tobytes()
+
+# --- BUILD-WORKSPACE (FESTE ASSETS + KLEINES SCRATCH-VERZEICHNIS PRO JOB) ---
+# latex_assets wird nicht mehr pro Klick kopiert: pdflatex findet Klasse und .clo/.sty
+# über TEXINPUTS direkt im (nur gelesenen) Asset-Ordner. Pro Job entsteht nur ein
+# Scratch-Verzeichnis für .tex/.aux/.pdf. Mit IUSTWRITE_BUILD_RETENTION_S > 0 bleiben
+# Scratch-Verzeichnisse so viele Sekunden liegen (z.B. zur Fehlersuche).
+ASSETS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "latex_assets")
+BUILD_ROOT = Path(os.environ.get("IUSTWRITE_BUILD_DIR", os.path.join(tempfile.gettempdir(), "iustwrite_builds")))
+BUILD_RETENTION_SECONDS = int(os.environ.get("IUSTWRITE_BUILD_RETENTION_S", "0"))
+
+class BuildWorkspace:
+    def __init__(self, assets_folder=ASSETS_FOLDER, retention=BUILD_RETENTION_SECONDS):
+        self.assets_folder = assets_folder
+        self.retention = retention
+        self.path = None
+
+    def __enter__(self):
+        BUILD_ROOT.mkdir(parents=True, exist_ok=True)
+        self.path = Path(tempfile.mkdtemp(prefix="job_", dir=BUILD_ROOT))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.retention <= 0:
+            shutil.rmtree(self.path, ignore_errors=True)
+        self.purge()
+        return False
+
+    def env(self):
+        env = os.environ.copy()
+        env["TEXINPUTS"] = f".:{self.assets_folder}:"
+        env["TEXFORMATS"] = f"{FMT_CACHE_DIR}:"
+        # Keine Zeilenumbrüche nach 79 Zeichen im Log (erleichtert die Auswertung)
+        env["max_print_line"] = "10000"
+        return env
+
+    def purge(self):
+        """Entfernt Scratch-Verzeichnisse, deren Aufbewahrungsfrist abgelaufen ist.
+
+        Mit Aufbewahrung gilt genau `retention` Sekunden (sollte länger als ein Build sein).
+        Ohne Aufbewahrung werden nur verwaiste Verzeichnisse (älter als eine Stunde,
+        z.B. nach einem Absturz) entfernt - laufende Jobs anderer Threads bleiben unberührt.
+        """
+        grenze = time.time() - (self.retention if self.retention > 0 else 3600)
+        for job_dir in BUILD_ROOT.glob("job_*"):
+            try:
+                if job_dir.stat().st_mtime < grenze:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+            except OSError:
+                pass
+
+def compile_document(head, body_chunks, tail, sachverhalt_path=None, sachverhalt_merge=False,
+                     warm_aux=None, cache_key=None, cancel_event=None):
+    """Kompiliert das Dokument in einem Scratch-Verzeichnis (ohne Streamlit-Aufrufe,
+    damit es auch in Worker-Threads läuft).
+
+    Kopf, Gutachten-Zeilen und Schluss werden direkt in klausur.tex gestreamt, der
+    vollständige Quelltext entsteht also nie als ein einziger String im Speicher.
+    Der Sachverhalt wird als temp_sv.pdf verlinkt und per \\includepdf eingebunden oder mit
+    `sachverhalt_merge` erst nach dem Lauf vor das fertige PDF gesetzt.
+
+    Gibt ein Dict mit "pdf" (Bytes oder None), "log" (pdflatex-Ausgabe), "messages"
+    (ausgewertete Fehler/Warnungen), "passes", "aux_state" und "metrics" zurück.
+    Erfolgreiche PDFs landen unter `cache_key` im PDF-Cache.
+    """
+    count_event("compiles")
+    with BuildWorkspace() as ws:
+        tmp_path = ws.path
+
+        # Immer über den eigenen Link im Scratch-Verzeichnis lesen, nie über die Ablage:
+        # Verwirft eine Session den Upload, bleibt dieser Build trotzdem intakt.
+        sv_lokal = tmp_path / "temp_sv.pdf"
+        if sachverhalt_path is not None:
+            with timed("asset_link"):
+                link_sachverhalt(sachverhalt_path, sv_lokal)
+
+        with timed("tex_assembly"), open(tmp_path / "klausur.tex", "w", encoding="utf-8") as f:
+            f.writelines(iter_latex_chunks(head, body_chunks, tail))
+
+        fmt = ensure_preamble_format(head, ws.assets_folder)
+        result, passes, aux_state, metrics = run_pdflatex(
+            tmp_path, ws.env(), warm_aux=warm_aux, fmt=fmt, cancel_event=cancel_event
+        )
+        if metrics and metrics[-1]["exit_reason"] in ("timeout", "cancelled", "signal"):
+            # Abgebrochene Läufe liefern kein (vollständiges) PDF und werden nicht gecacht
+            count_event("compile_failures")
+            return {"pdf": None, "log": result.stdout, "messages": [], "passes": passes,
+                    "aux_state": warm_aux, "metrics": metrics}
+
+        pdf_bytes = None
+        pdf_file = tmp_path / "klausur.pdf"
+        if pdf_file.exists():
+            pdf_bytes = pdf_file.read_bytes()
+            if sachverhalt_path is not None and sachverhalt_merge:
+                with timed("sachverhalt_merge"):
+                    pdf_bytes = merge_sachverhalt(sv_lokal, pdf_bytes) or pdf_bytes
+            if cache_key:
+                pdf_cache_put(cache_key, pdf_bytes)
+        else:
+            count_event("compile_failures")
+
+        # Log zeilenweise aus der Datei lesen (Fallback: stdout) und auf Editorzeilen abbilden
+        line_map = build_line_map(body_chunks)
+        head_lines = head.count("\n")
+        log_file = tmp_path / "klausur.log"
+        if log_file.exists():
+            with open(log_file, "rb") as f:
+                messages = parse_pdflatex_log(f, head_lines, line_map)
+        else:
+            messages = parse_pdflatex_log((result.stdout if result else b"").splitlines(), head_lines, line_map)
+
+    return {
+        "pdf": pdf_bytes,
+        "log": result.stdout if result else b"",
+        "messages": messages,
+        "passes": passes,
+        "aux_state": aux_state,
+        "metrics": metrics,
+    }
+
+# --- VORSCHAU (NUR EIN ABSCHNITT, EIN LAUF, PNG IN NIEDRIGER AUFLÖSUNG) ---
+PREVIEW_DPI = 60
+PREVIEW_MAX_PAGES = 3
+PREVIEW_TIMEOUT_S = 20
+
+def section_range(outline, start_line, line_count):
+    """Zeilenbereich [start, ende) des Abschnitts ab `start_line` bis zur nächsten
+    Überschrift gleicher oder höherer Ebene (oder Dokumentende)."""
+    level = None
+    for entry in outline:
+        if entry.line == start_line:
+            level = entry.level
+        elif level is not None and entry.line > start_line and entry.level <= level:
+            return start_line, entry.line
+    return start_line, line_count
+
+def compile_preview(head, body_chunks, tail, first_line=1, dpi=PREVIEW_DPI, max_pages=PREVIEW_MAX_PAGES,
+                    cancel_event=None):
+    """Kompiliert einen Ausschnitt in einem einzigen Lauf und rendert die ersten Seiten als PNG.
+
+    pdflatex wird nach PREVIEW_TIMEOUT_S beendet. Gibt (Liste von PNG-Bytes, Log-Meldungen,
+    Abbruchgrund des Laufs) zurück.
+    """
+    with BuildWorkspace() as ws:
+        with open(ws.path / "klausur.tex", "w", encoding="utf-8") as f:
+            f.writelines(iter_latex_chunks(head, body_chunks, tail))
+        fmt = ensure_preamble_format(head, ws.assets_folder)
+        result, _, _, metrics = run_pdflatex(
+            ws.path, ws.env(), max_passes=1, fmt=fmt, cancel_event=cancel_event, timeout=PREVIEW_TIMEOUT_S
+        )
+
+        bilder = []
+        pdf_file = ws.path / "klausur.pdf"
+        if pdf_file.exists():
+            import pymupdf  # nur für die Vorschau benötigt
+            with pymupdf.open(pdf_file) as doc:
+                for page in doc.pages(0, min(max_pages, doc.page_count)):
+                    bilder.append(page.get_pixmap(dpi=dpi).tobytes("png"))
+        messages = parse_pdflatex_log(
+            (result.stdout if result else b"").splitlines(), head.count("\n"), build_line_map(body_chunks, first_line)
+        )
+    exit_reason = metrics[-1]["exit_reason"] if metrics else "error"
+    return bilder, messages, exit_reason
+
+# --- COMPILE-SCHEDULER (BEGRENZTER WORKER-POOL + FIFO-WARTESCHLANGE) ---
+# Fertige Aufträge, die keine Session mehr abholt (Tab geschlossen), werden danach verworfen
+FINISHED_JOB_TTL_S = int(os.environ.get("IUSTWRITE_FINISHED_JOB_TTL_S", "600"))
+
+class CompileJob:
+    def __init__(self, key):
+        self.job_id = uuid.uuid4().hex
+        self.key = key
+        self.started = False
+        self.future = None
+        self.submitted_at = time.monotonic()
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+
+    def _mark_finished(self, _future):
+        self.finished_at = time.monotonic()
+
+class CompileScheduler:
+    """Sessionübergreifender Pool mit fester Größe (= CPU-Kerne).
+
+    Aufträge warten FIFO; pro Session gibt es höchstens einen offenen Auftrag:
+    Derselbe Inhalt wird nicht doppelt eingereiht, ein älterer Auftrag wird durch
+    einen neuen ersetzt (wartend: gestrichen, laufend: abgebrochen). Die Job-Funktion
+    erhält dazu das Keyword-Argument `cancel_event`. Fertige Aufträge, die nicht binnen
+    `finished_ttl` Sekunden per release() abgeholt werden, fallen beim nächsten Zugriff weg.
+    """
+    def __init__(self, max_workers, finished_ttl=FINISHED_JOB_TTL_S):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pdflatex")
+        self._lock = threading.Lock()
+        self._pending = []
+        self._by_session = {}
+        self.finished_ttl = finished_ttl
+        self._last_sweep = time.monotonic()
+
+    def _sweep_locked(self):
+        now = time.monotonic()
+        if now - self._last_sweep < min(60, self.finished_ttl):
+            return
+        self._last_sweep = now
+        grenze = now - self.finished_ttl
+        for session_id, job in list(self._by_session.items()):
+            if job.finished_at is not None and job.finished_at < grenze:
+                del self._by_session[session_id]
+
+    def submit(self, session_id, key, fn, *args, **kwargs):
+        with self._lock:
+            self._sweep_locked()
+            job = self._by_session.get(session_id)
+            if job is not None and not job.future.done():
+                if job.key == key:
+                    return job
+                self._cancel_locked(job)
+            job = CompileJob(key)
+            self._pending.append(job)
+            job.future = self._executor.submit(self._run, job, fn, args, kwargs)
+            job.future.add_done_callback(job._mark_finished)
+            self._by_session[session_id] = job
+            return job
+
+    def _run(self, job, fn, args, kwargs):
+        with self._lock:
+            job.started = True
+            if job in self._pending:
+                self._pending.remove(job)
+        return fn(*args, cancel_event=job.cancel_event, **kwargs)
+
+    def _cancel_locked(self, job):
+        if not job.started and job.future.cancel():
+            self._pending.remove(job)
+        else:
+            job.cancel_event.set()  # laufenden pdflatex-Prozess beenden
+
+    def cancel(self, job):
+        with self._lock:
+            self._cancel_locked(job)
+
+    def job_for(self, session_id):
+        with self._lock:
+            self._sweep_locked()
+            return self._by_session.get(session_id)
+
+    def release(self, session_id, job):
+        with self._lock:
+            if self._by_session.get(session_id) is job:
+                del self._by_session[session_id]
+
+    def discard(self, session_id):
+        """Bricht den offenen Auftrag der Session ab (falls vorhanden) und verwirft ihn."""
+        with self._lock:
+            job = self._by_session.pop(session_id, None)
+            if job is not None and not job.future.done():
+                self._cancel_locked(job)
+
+    def position(self, job):
+        """1-basierte Position in der Warteschlange, 0 = wird gerade kompiliert."""
+        with self._lock:
+            if job in self._pending:
+                return self._pending.index(job) + 1
+            return 0
+
+@st.cache_resource
+def get_compile_scheduler():
+    return CompileScheduler(max_workers=os.cpu_count() or 2)
+
+# --- FALL-BIBLIOTHEK (INDEX ÜBER fealle/) ---
+class FallBibliothek:
+    """Hält alle Fälle aus `fealle/` im Speicher: Code -> (Titel, Text, mtime).
+
+    Der Ordner wird höchstens alle `refresh_interval` Sekunden auf geänderte mtimes
+    geprüft; Abrufe sind reine Dict-Zugriffe. Codes werden NFC-normalisiert und
+    ohne Groß-/Kleinschreibung verglichen (StR1 = str1).
+    """
+    def __init__(self, ordner="fealle", refresh_interval=10.0):
+        self.ordner = ordner
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._faelle = {}
+        self._last_scan = 0.0
+        self._refresh(force=True)
+
+    @staticmethod
+    def _norm(code):
+        return unicodedata.normalize("NFC", code.strip()).casefold()
+
+    @staticmethod
+    def _parse(ganzer_text):
+        zeilen = ganzer_text.split('\n')
+        sauberer_titel = re.sub(r'^#+\s*(Fall\s+\d+:\s*)?', '', zeilen[0]).strip()
+        rest_text = "\n".join(zeilen[1:]).strip()
+        return sauberer_titel, rest_text
+
+    def _refresh(self, force=False):
+        jetzt = time.monotonic()
+        if not force and jetzt - self._last_scan < self.refresh_interval:
+            return
+        with self._lock:
+            self._last_scan = jetzt
+            neu = {}
+            try:
+                eintraege = list(os.scandir(self.ordner))
+            except OSError:
+                eintraege = []
+            for entry in eintraege:
+                if not entry.name.endswith(".txt") or not entry.is_file():
+                    continue
+                code = unicodedata.normalize("NFC", entry.name[:-4])
+                key = self._norm(code)
+                mtime = entry.stat().st_mtime_ns
+                alt = self._faelle.get(key)
+                if alt is not None and alt["mtime"] == mtime:
+                    neu[key] = alt
+                    continue
+                try:
+                    with open(entry.path, "r", encoding="utf-8") as f:
+                        titel, text = self._parse(f.read())
+                except (OSError, UnicodeDecodeError):
+                    continue
+                neu[key] = {"code": code, "titel": titel, "text": text, "mtime": mtime}
+            self._faelle = neu
+
+    def get(self, code):
+        """Fall zum Code oder None."""
+        self._refresh()
+        return self._faelle.get(self._norm(code))
+
+    def search(self, query, limit=5):
+        """Vorschläge: erst Präfix-Treffer auf den Code, dann Treffer im Titel, dann unscharf."""
+        self._refresh()
+        q = self._norm(query)
+        if not q:
+            return []
+        faelle = self._faelle
+        treffer = [k for k in sorted(faelle) if k.startswith(q)]
+        treffer += [k for k in sorted(faelle) if k not in treffer and q in faelle[k]["titel"].casefold()]
+        treffer += [k for k in difflib.get_close_matches(q, faelle.keys(), n=limit, cutoff=0.6) if k not in treffer]
+        return [faelle[k] for k in treffer[:limit]]
+
+@st.cache_resource
+def get_fall_bibliothek():
+    return FallBibliothek()
+
+# --- AUTOSAVE (LOCALSTORAGE: NUR ÄNDERUNGEN, GEDROSSELT, GROSSE TEXTE KOMPRIMIERT) ---
+AUTOSAVE_INTERVAL_S = float(os.environ.get("IUSTWRITE_AUTOSAVE_S", "5"))
+AUTOSAVE_HEARTBEAT_S = float(os.environ.get("IUSTWRITE_AUTOSAVE_HEARTBEAT_S", "30"))
+AUTOSAVE_CHUNK_MIN = 8000    # Zeichen; ab 2x dieser Größe wird in Chunks gespeichert
+AUTOSAVE_CHUNK_MAX = 32000
+
+class AutoSaver:
+    """Sichert Editorinhalt und Stammdaten im LocalStorage des Browsers.
+
+    - Pro Speicherschlüssel wird der Hash des zuletzt geschriebenen Werts gemerkt;
+      unveränderte Werte lösen keinen Komponenten-Roundtrip aus.
+    - Schreibvorgänge finden höchstens alle `interval` Sekunden statt.
+    - Große Texte werden an inhaltsabhängigen Zeilengrenzen in Chunks zerlegt und
+      einzeln (zlib + base64) gespeichert, sodass nach einer Änderung nur die
+      betroffenen Chunks übertragen werden. `<key>__chunks` enthält dann "<n>:<sha1>".
+    """
+    def __init__(self, ls, state, interval=AUTOSAVE_INTERVAL_S):
+        self.ls = ls
+        self.state = state
+        self.interval = interval
+        state.setdefault("hashes", {})
+        state.setdefault("last_save", 0.0)
+        state.setdefault("aus_chunks", set())  # Werte, die load() aus Chunks gelesen hat
+
+    @staticmethod
+    def _digest(value):
+        return hashlib.sha1(value.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _split(text):
+        """Chunk-Grenzen hängen nur vom Inhalt ab (CRC der Zeile), nicht von festen Offsets."""
+        chunks, aktuell, groesse = [], [], 0
+        for line in text.split("\n"):
+            aktuell.append(line)
+            groesse += len(line) + 1
+            if groesse >= AUTOSAVE_CHUNK_MAX or (groesse >= AUTOSAVE_CHUNK_MIN and zlib.crc32(line.encode("utf-8")) & 7 == 0):
+                chunks.append("\n".join(aktuell))
+                aktuell, groesse = [], 0
+        chunks.append("\n".join(aktuell))
+        return chunks
+
+    def _encode(self, item_key, value):
+        """Speicherschlüssel -> Payload für einen Wert."""
+        if len(value) < 2 * AUTOSAVE_CHUNK_MIN:
+            payload = {item_key: value}
+            if self.state["hashes"].get(f"{item_key}__chunks") not in (None, "0"):
+                payload[f"{item_key}__chunks"] = "0"  # zurück auf Klartext umstellen
+            return payload
+        chunks = self._split(value)
+        payload = {
+            f"{item_key}__{i}": base64.b64encode(zlib.compress(chunk.encode("utf-8"), 6)).decode("ascii")
+            for i, chunk in enumerate(chunks)
+        }
+        payload[f"{item_key}__chunks"] = f"{len(chunks)}:{self._digest(value)}"
+        return payload
+
+    def load(self, item_key):
+        """Liest einen (ggf. gechunkten) Wert; fällt bei Inkonsistenz auf den Klartext zurück."""
+        with timed("localstorage_get"):
+            manifest = self.ls.getItem(f"{item_key}__chunks")
+        if manifest and manifest != "0":
+            try:
+                n, digest = manifest.split(":", 1)
+                teile = []
+                for i in range(int(n)):
+                    with timed("localstorage_get"):
+                        chunk = self.ls.getItem(f"{item_key}__{i}")
+                    teile.append(zlib.decompress(base64.b64decode(chunk)).decode("utf-8"))
+                value = "\n".join(teile)
+                if self._digest(value) == digest:
+                    self.state["aus_chunks"].add(item_key)
+                    return value
+            except (ValueError, TypeError, zlib.error):
+                pass
+        self.state["aus_chunks"].discard(item_key)
+        with timed("localstorage_get"):
+            return self.ls.getItem(item_key)
+
+    def mark_saved(self, items):
+        """Merkt geladene Werte als gespeichert, damit sie nicht sofort zurückgeschrieben werden.
+
+        Markiert werden nur die Schlüssel, die tatsächlich gelesen wurden: Kam ein großer Text
+        aus dem Klartext-Schlüssel (ältere Backups), schreibt der nächste save() alle Chunks.
+        """
+        for item_key, value in items.items():
+            if value:
+                if item_key in self.state["aus_chunks"]:
+                    gelesen = self._encode(item_key, value)
+                else:
+                    gelesen = {item_key: value}
+                for storage_key, payload in gelesen.items():
+                    self.state["hashes"][storage_key] = payload if storage_key.endswith("__chunks") else self._digest(payload)
+
+    def save(self, items, force=False):
+        """Schreibt geänderte Werte; gibt False zurück, wenn gedrosselt wurde."""
+        jetzt = time.monotonic()
+        if not force and jetzt - self.state["last_save"] < self.interval:
+            return False
+        hashes = self.state["hashes"]
+        for item_key, value in items.items():
+            if not value:
                 continue
+            for storage_key, payload in self._encode(item_key, value).items():
+                # Manifeste werden direkt verglichen, alles andere über den Hash
+                merkmal = payload if storage_key.endswith("__chunks") else self._digest(payload)
+                if hashes.get(storage_key) == merkmal:
+                    continue
+                with timed("localstorage_set"):
+                    self.ls.setItem(storage_key, payload, key=f"autosave_{storage_key}")
+                hashes[storage_key] = merkmal
+        self.state["last_save"] = jetzt
+        return True
 
-            found_level = False
-            # --- 1. BLOCK: Verarbeitung der Sternchen-Überschriften (Versteckte Gliederung) ---
-            for level, pattern in self.star_patterns.items():
-                match = re.match(pattern, line_s)
-                if match:
-                    cmds = {1: "section*", 2: "subsection*", 3: "subsubsection*"}
-                    cmd = cmds.get(level, "subsubsection*")
-                    
-                    # Hier wird der Marker (z.B. "Teil 1*") abgeschnitten
-                    display_text = line_s[match.end():].strip()
-                    
-                    # Falls kein Text nach dem Sternchen folgt, nimm die Zeile ohne Stern
-                    if not display_text:
-                        display_text = line_s.replace('*', '').strip()
-                        
-                    latex_output.append(f"\\{cmd}{{{display_text}}}")
-                    found_level = True
-                    break
-
-           # --- 2. BLOCK: Verarbeitung der normalen Überschriften (In Gliederung) ---
-            if not found_level:
-                for level, pattern in self.prefix_patterns.items():
-                    if re.match(pattern, line_s):
-                        # --- NEU: Prüfung auf manuelles Fett-Sternchen am Ende ---
-                        # Wenn die Zeile auf * endet (z.B. "A. Diebstahl*")
-                        manual_bold = False
-                        if line_s.endswith('*'):
-                            manual_bold = True
-                            line_s = line_s[:-1].strip() # Sternchen für die Ausgabe entfernen
-                        
-                        if level >= 3:
-                            cmd = "subsubsection*"
-                        elif level == 2:
-                            cmd = "subsection*"
-                        else:
-                            cmd = "section*"
-                        
-                        # --- FORMATIERUNG & EINRÜCKUNG ---
-                        # Wenn es Ebene 1 ist ODER das manuelle Sternchen gesetzt wurde -> FETT
-                        if level == 1 or manual_bold:
-                            display_text = f"\\textbf{{{line_s}}}"
-                        else:
-                            display_text = line_s
-                        
-                        # Einrückungs-Logik (deine aktuellen Werte)
-                        if level == 1:
-                            indent_val = 0.0
-                        else:
-                            if level == 2:
-                                indent_val = -1.4
-                            elif level == 3:
-                                indent_val = -1.6
-                            else:
-                                indent_val = -1.6 + (level - 3) * 1.0
-                        
-                        toc_indent = f"{indent_val}em"
-                        
-                        # Ausgabe im Dokument
-                        latex_output.append(f"\\{cmd}{{{display_text}}}")
-                        
-                        # Eintrag ins Inhaltsverzeichnis (TOC)
-                        toc_cmd = "subsubsection" if level >= 3 else cmd.replace("*", "")
-                        latex_output.append(f"\\addcontentsline{{toc}}{{{toc_cmd}}}{{\\hspace{{{toc_indent}}}{display_text}}}")
-                        
-                        found_level = True
-                        break
-            if not found_level:
-                line_s = re.sub(self.footnote_pattern, r'\\footnote{\1}', line_s)
-                line_s = line_s.replace('&', '\\&').replace('%', '\\%')
-                latex_output.append(line_s)
-        return "\n".join(latex_output)
+    def forget(self):
+        """Nach dem Löschen des Browser-Speichers: nächster save() schreibt alles neu."""
+        self.state["hashes"] = {}
+        self.state["last_save"] = 0.0
+
+    def clear(self, item_keys):
+        """Entfernt Werte samt Chunk-Manifest und allen Chunks aus dem LocalStorage."""
+        for item_key in item_keys:
+            storage_keys = {item_key, f"{item_key}__chunks"}
+            storage_keys.update(k for k in self.state["hashes"] if k.startswith(f"{item_key}__"))
+            # Chunks aus früheren Sitzungen kennt nur das gespeicherte Manifest
+            with timed("localstorage_get"):
+                manifest = self.ls.getItem(f"{item_key}__chunks")
+            try:
+                anzahl = int(str(manifest).split(":", 1)[0])
+            except ValueError:
+                anzahl = 0
+            storage_keys.update(f"{item_key}__{i}" for i in range(anzahl))
+            for storage_key in sorted(storage_keys):
+                self.ls.eraseItem(storage_key, key=f"erase_{storage_key}")
+        self.forget()
 
 # --- UI CONFIG ---
-st.set_page_config(page_title="IustWrite Editor", layout="wide", initial_sidebar_state="expanded")
+# Gemeinsam mit batch.py genutzt: Anzeigename -> LaTeX-Paket
+FONT_OPTIONS = {"lmodern (Standard)": "lmodern", "Times": "mathptmx", "Palatino": "mathpazo", "Helvetica": "helvet"}
+ZEILENABSTAND_OPTIONS = ["1.0", "1.2", "1.5", "2.0"]
 
-if "main_editor_key" not in st.session_state:
-    st.session_state["main_editor_key"] = ""
+def normalize_rand(rand_wert):
+    """Korrekturrand ohne Einheit wird als cm interpretiert."""
+    if not any(unit in rand_wert for unit in ['cm', 'mm']):
+        rand_wert += "cm"
+    return rand_wert
 
 def handle_upload():
     if st.session_state.uploader_key is not None:
@@ -127,8 +1700,16 @@ def handle_upload():
         st.session_state["main_editor_key"] = content
 
 def main():
+    # Erst hier statt beim Import, damit batch.py das Modul ohne Streamlit-Sitzung laden kann
+    st.set_page_config(page_title="IustWrite Editor", layout="wide", initial_sidebar_state="expanded")
+    if "main_editor_key" not in st.session_state:
+        st.session_state["main_editor_key"] = ""
+
     ls = LocalStorage() 
     doc_parser = KlausurDocument()
+    # Dokumentmodell der Session: nur geänderte Zeilen werden neu übersetzt
+    doc_model = st.session_state.setdefault("doc_model", DocumentModel())
+    autosaver = AutoSaver(ls, st.session_state.setdefault("autosave_state", {}))
     
     # --- 1. DIE LÖSCH-FUNKTION (Nur einmal definieren) ---
     def reset_gutachten():
@@ -138,23 +1719,24 @@ def main():
         st.session_state["stamm_datum"] = ""
         st.session_state["stamm_kuerzel"] = ""
         
-        # Browser-Speicher leeren
-        try:
-            ls.removeItem("iustwrite_backup")
-            ls.removeItem("iustwrite_titel")
-            ls.removeItem("iustwrite_datum")
-            ls.removeItem("iustwrite_kuerzel")
-        except:
-            pass
+        # Browser-Speicher leeren (inklusive gechunkter Backups)
+        autosaver.clear(["iustwrite_backup", "iustwrite_titel", "iustwrite_datum", "iustwrite_kuerzel"])
         st.toast("Neues Gutachten gestartet.")
 
     # --- 2. INITIAL-LADEN (Beim ersten Seitenaufruf) ---
     if "initialized" not in st.session_state:
         try:
-            st.session_state["main_editor_key"] = ls.getItem("iustwrite_backup") or ""
-            st.session_state["stamm_titel"] = ls.getItem("iustwrite_titel") or ""
-            st.session_state["stamm_datum"] = ls.getItem("iustwrite_datum") or ""
-            st.session_state["stamm_kuerzel"] = ls.getItem("iustwrite_kuerzel") or ""
+            st.session_state["main_editor_key"] = autosaver.load("iustwrite_backup") or ""
+            with timed("localstorage_get"):
+                st.session_state["stamm_titel"] = ls.getItem("iustwrite_titel") or ""
+                st.session_state["stamm_datum"] = ls.getItem("iustwrite_datum") or ""
+                st.session_state["stamm_kuerzel"] = ls.getItem("iustwrite_kuerzel") or ""
+            autosaver.mark_saved({
+                "iustwrite_backup": st.session_state["main_editor_key"],
+                "iustwrite_titel": st.session_state["stamm_titel"],
+                "iustwrite_datum": st.session_state["stamm_datum"],
+                "iustwrite_kuerzel": st.session_state["stamm_kuerzel"],
+            })
         except:
             st.session_state["main_editor_key"] = ""
             # Falls Felder fehlen, leer initialisieren
@@ -163,8 +1745,7 @@ def main():
         
         st.session_state["initialized"] = True
 
-    # --- 3. UI-ELEMENTE (Autorefresh & Button) ---
-    st_autorefresh(interval=30000, key="autosave_heartbeat")
+    # --- 3. UI-ELEMENTE ---
     
     # CSS für maximale Breite, bewegliche Sidebar und LESERLICHE Schrift
     st.markdown("""
@@ -244,6 +1825,9 @@ def main():
             | **8** | `(a)` | Buchstabe in Klammern |
             | **9** | `(aa)`| Doppel-Buchstabe in Klammern |
             
+            Unter **Layout-Einstellungen → Gliederungsschema** lässt sich die Reihenfolge umstellen, z. B. `1. Teil` (Trier), ohne Teil-Ebene mit `A.` beginnend (Göttingen) oder `I.` vor `A.` (St. Gallen).
+            Römische Zahlen werden bis `XXXIX.` erkannt.
+            
             **Tipps für Profis:**
             * **Erzwungener Fettdruck:** Standardmäßig wird nur die Ebene 1 (`Teil. 1`) in der Gliederung fett dargestellt. Wenn du aber ein Sternchen ans Ende der Zeile setzt (z. B. `A. Diebstahl*`), wird die Überschrift in der Gliederung fett gedruckt. Dies ist z. B. im Strafrecht sinnvoll, um eine übersichtliche Gliederung zu erhalten.
             * **Versteckte Gliederung:** Nutzt du den Stern direkt nach dem Kürzel (z.B. `A* Hilfsgutachten`), erscheint 
@@ -285,7 +1869,7 @@ def main():
             """)
             
             st.write("""
-            **Sonderzeichen:** Zeichen wie `&`, `%` oder `$` werden vom Editor automatisch erkannt 
+            **Sonderzeichen:** Zeichen wie `&`, `%`, `$`, `#` oder `_` werden vom Editor automatisch erkannt 
             und für LaTeX "entschärft". Du kannst sie also ganz normal im Text verwenden.
             """)
 
@@ -332,11 +1916,12 @@ def main():
             
         with tab_dsgvo:
             st.success("🛡️ Datensicherheit & DSGVO")
-            st.markdown("""
+            st.markdown(f"""
             Dieses Tool wurde nach dem Prinzip **'Privacy by Design'** entwickelt und nutzt die native Architektur von Streamlit zur maximalen Datentrennung:
             
             * **Isolierte Sessions:** Jedes Mal, wenn du diese Seite lädst, wird eine komplett neue, isolierte Instanz (Session) auf dem Server gestartet. Deine Daten sind strikt von anderen Nutzern getrennt.
-            * **Flüchtiger Arbeitsspeicher (RAM):** Deine Texte werden ausschließlich im Arbeitsspeicher der laufenden Session verarbeitet. Es findet **keine persistente Speicherung** in einer Datenbank oder auf Festplatten statt.
+            * **Flüchtiger Arbeitsspeicher (RAM):** Deine Texte werden ausschließlich im Arbeitsspeicher der laufenden Session verarbeitet. Es findet **keine persistente Speicherung** in einer Datenbank statt. Lediglich fertig erzeugte PDFs werden in einem größenbegrenzten, temporären Zwischenspeicher vorgehalten, damit identische Dokumente nicht erneut erzeugt werden müssen; ältere Einträge werden automatisch verdrängt.
+            * **Hochgeladene Sachverhalte:** Ein Sachverhalt-PDF wird für die Bearbeitung in einem temporären Verzeichnis auf dem Server abgelegt (einmal pro Inhalt, damit es nicht bei jedem Build neu geschrieben wird). Entfernst du den Upload, wird deine Kopie sofort gelöscht (die Datei selbst, sobald keine andere Sitzung denselben Sachverhalt nutzt); andernfalls wird sie nach {SV_STORE_MAX_AGE_S // 3600} Stunden ohne Verwendung bei der nächsten Bereinigung entfernt.
             * **Automatisches Purging:** Sobald du den Browser-Tab schließt oder die Verbindung unterbrochen wird, wird die zugehörige Session auf dem Server terminiert. Alle im RAM befindlichen Daten deines Gutachtens werden dabei **unwiderruflich gelöscht**.
             * **Lokale Souveränität (LocalStorage):** Das Auto-Save-Backup nutzt den *LocalStorage* deines eigenen Browsers. Das bedeutet: Die Sicherung deines Textes verlässt nie dein Endgerät, bis du explizit auf 'PDF generieren' klickst.
             * **Keine KI-Verwertung:** Im Gegensatz zu kommerziellen Online-Editoren werden deine juristischen Ausführungen **nicht** zur Verbesserung von Sprachmodellen (LLM) oder zu Analysezwecken ausgewertet.
@@ -360,13 +1945,15 @@ def main():
     st.sidebar.markdown("---")
     
     with st.sidebar.expander("⚙️ Layout-Einstellungen", expanded=False):
-        rand_wert = st.text_input("Korrekturrand rechts (in cm)", value="6")
-        if not any(unit in rand_wert for unit in ['cm', 'mm']): 
-            rand_wert += "cm"
-        zeilenabstand = st.selectbox("Zeilenabstand", options=["1.0", "1.2", "1.5", "2.0"], index=1)
-        font_options = {"lmodern (Standard)": "lmodern", "Times": "mathptmx", "Palatino": "mathpazo", "Helvetica": "helvet"}
-        font_choice = st.selectbox("Schriftart", options=list(font_options.keys()), index=0)
-        selected_font_package = font_options[font_choice]
+        rand_wert = normalize_rand(st.text_input("Korrekturrand rechts (in cm)", value="6"))
+        zeilenabstand = st.selectbox("Zeilenabstand", options=ZEILENABSTAND_OPTIONS, index=1)
+        font_choice = st.selectbox("Schriftart", options=list(FONT_OPTIONS.keys()), index=0)
+        selected_font_package = FONT_OPTIONS[font_choice]
+        gliederung_schema = st.selectbox(
+            "Gliederungsschema", options=list(GLIEDERUNGSSCHEMATA), key="gliederung_schema",
+            format_func=lambda name: GLIEDERUNGSSCHEMATA[name]["titel"]
+        )
+        doc_parser.set_schema(gliederung_schema)
 
     with st.sidebar.expander("📖 Fall abrufen", expanded=False):
         fall_code = st.text_input("Fall-Code eingeben")
@@ -375,18 +1962,15 @@ def main():
     st.sidebar.title("📌 Gliederung")
 
     if fall_code:
-        pfad_zu_fall = os.path.join("fealle", f"{fall_code}.txt")
-        if os.path.exists(pfad_zu_fall):
-            with open(pfad_zu_fall, "r", encoding="utf-8") as f:
-                ganzer_text = f.read()
-            zeilen = ganzer_text.split('\n')
-            if zeilen:
-                sauberer_titel = re.sub(r'^#+\s*(Fall\s+\d+:\s*)?', '', zeilen[0]).strip()
-                rest_text = "\n".join(zeilen[1:]).strip()
-                with st.expander(f"📄 {sauberer_titel}", expanded=True):
-                    st.markdown(f'<div class="sachverhalt-box">{rest_text}</div>', unsafe_allow_html=True)
+        fall = get_fall_bibliothek().get(fall_code)
+        if fall is not None:
+            with st.expander(f"📄 {fall['titel']}", expanded=True):
+                st.markdown(f'<div class="sachverhalt-box">{fall["text"]}</div>', unsafe_allow_html=True)
         else:
             st.sidebar.error(f"Fall {fall_code} nicht gefunden.")
+            vorschlaege = get_fall_bibliothek().search(fall_code)
+            if vorschlaege:
+                st.sidebar.caption("Meintest du: " + ", ".join(f"`{v['code']}` ({v['titel']})" for v in vorschlaege))
 
     # --- TITELZEILE ---
     c1, c2, c3 = st.columns([3, 1, 1])
@@ -411,42 +1995,60 @@ def main():
         key="main_editor_key"
     )
 
-    # 5. SOFORT-BACKUP (Nach jeder Änderung)
-    if st.session_state["main_editor_key"]:
-        try:
-            ls.setItem("iustwrite_backup", st.session_state["main_editor_key"])
-            ls.setItem("iustwrite_titel", st.session_state["stamm_titel"])
-            ls.setItem("iustwrite_datum", st.session_state["stamm_datum"])
-            ls.setItem("iustwrite_kuerzel", st.session_state["stamm_kuerzel"])
-        except:
-            pass
+    # 5. BACKUP (nur Geändertes, höchstens alle AUTOSAVE_INTERVAL_S Sekunden)
+    # Als Fragment: Der Herzschlag alle AUTOSAVE_HEARTBEAT_S Sekunden führt nur diese
+    # Funktion erneut aus - nicht das ganze Skript (kein Parsen, kein Rendern, kein Fall-Abruf).
+    @st.fragment(run_every=AUTOSAVE_HEARTBEAT_S)
+    def autosave():
+        if st.session_state["main_editor_key"]:
+            try:
+                autosaver.save({
+                    "iustwrite_backup": st.session_state["main_editor_key"],
+                    "iustwrite_titel": st.session_state["stamm_titel"],
+                    "iustwrite_datum": st.session_state["stamm_datum"],
+                    "iustwrite_kuerzel": st.session_state["stamm_kuerzel"],
+                })
+            except:
+                pass
+
+    autosave()
+
+    # Einmal pro Rerun abgleichen; Zähler, Gliederung, PDF und Vorschau lesen nur noch daraus
+    with timed("parse"):
+        doc_model.update(current_text, doc_parser)
 
     # --- NEU: ZEICHENZÄHLER ---
     if current_text:
-        char_count = len(current_text)
-        word_count = len(current_text.split())
         # Anzeige direkt unter dem Editor
-        st.markdown(f"*📝 {char_count} Zeichen | {word_count} Wörter*")
+        st.markdown(f"*📝 {doc_model.char_count} Zeichen | {doc_model.word_count} Wörter*")
 
     # --- SIDEBAR OUTLINE ---
+    # Kommt aus demselben Parser-Durchlauf wie der LaTeX-Code und wird als EIN Element gerendert
     if current_text:
-        for line in current_text.split('\n'):
-            line_s = line.strip()
-            if not line_s: continue
-            found = False
-            for level, pattern in doc_parser.star_patterns.items():
-                if re.match(pattern, line_s):
-                    indent = "&nbsp;" * (level * 2)
-                    st.sidebar.markdown(f"{indent}{line_s}")
-                    found = True
-                    break
-            if not found:
-                for level, pattern in doc_parser.prefix_patterns.items():
-                    if re.match(pattern, line_s):
-                        indent = "&nbsp;" * (level * 2)
-                        weight = "**" if level <= 2 else ""
-                        st.sidebar.markdown(f"{indent}{weight}{line_s}{weight}")
-                        break
+        zeilen_html = []
+        with timed("outline"):
+            for entry in doc_model.outline():
+                indent = "&nbsp;" * (entry.level * 2)
+                weight = "**" if entry.level <= 2 and not entry.starred else ""
+                zeilen_html.append(f"{indent}{weight}{html.escape(entry.text, quote=False)}{weight}")
+        if zeilen_html:
+            st.sidebar.markdown("<br>".join(zeilen_html), unsafe_allow_html=True)
+
+    # --- DEBUG-PANEL (NUR MIT METRIKEN UND ADMIN-TOKEN) ---
+    # Als Bytes vergleichen: compare_digest lehnt Nicht-ASCII-Strings (z.B. ?admin=ä) mit TypeError ab
+    if METRICS_ENABLED and METRICS_ADMIN_TOKEN and hmac.compare_digest(
+            st.query_params.get("admin", "").encode("utf-8"), METRICS_ADMIN_TOKEN.encode("utf-8")):
+        with st.sidebar.expander("🔧 Metriken", expanded=False):
+            stages, counters = METRICS.snapshot()
+            if stages:
+                st.dataframe(
+                    [{"Stufe": stage, "n": e["count"], "p50 ms": e["p50"] * 1000,
+                      "p95 ms": e["p95"] * 1000, "p99 ms": e["p99"] * 1000} for stage, e in stages.items()],
+                    hide_index=True, use_container_width=True
+                )
+            if counters:
+                st.markdown("  \n".join(f"`{name}`: {wert}" for name, wert in counters.items()))
+            st.code(METRICS.render_prometheus(), language="text")
 
     # --- ACTIONS ---
     st.markdown("---")
@@ -462,76 +2064,25 @@ def main():
         pdf_button = st.button("🏁 PDF generieren", use_container_width=True)
 
     with col_save:
+        # Beide Exporte werden erst beim Klick erzeugt (callable statt fertigem String),
+        # damit der Dokumenttext nicht bei jedem Rerun in die Frontend-Nachricht wandert.
         # TXT-Button
         st.download_button(
             label="💾 Als TXT speichern", 
-            data=current_text, 
+            data=lambda: current_text, 
             file_name=f"{dateiname_basis}.txt", 
             use_container_width=True
         )
 
         # TEX-Button (Direkt darunter in derselben Spalte)
-        # Wir bereiten den Inhalt vor
-        parsed_content = doc_parser.parse_content(current_text.split('\n'))
-        if kl_datum.strip():
-            titel_komp = f"{kl_titel} ({kl_datum})"
-        else:
-            titel_komp = kl_titel
-        
-        font_latex = f"\\usepackage{{{selected_font_package}}}"
-        if "helvet" in selected_font_package: 
-            font_latex += "\n\\renewcommand{\\familydefault}{\\sfdefault}"
-
-        full_tex_code = r"""\documentclass[12pt, a4paper, oneside]{jurabook}
-\usepackage[ngerman]{babel}
-\usepackage[utf8]{inputenc}
-\usepackage[T1]{fontenc}
-\usepackage{pdfpages}
-\usepackage[hidelinks]{hyperref}
-\usepackage{xurl}
-\usepackage{xcolor}
-
-\definecolor{myRed}{RGB}{190, 20, 20}
-\definecolor{myBlue}{RGB}{0, 80, 160}
-\definecolor{myGreen}{RGB}{0, 120, 50}
-
-\newcommand{\red}[1]{{\color{myRed}#1}}
-\newcommand{\blue}[1]{{\color{myBlue}#1}}
-\newcommand{\green}[1]{{\color{myGreen}#1}}
-
-\addto\captionsngerman{\renewcommand{\contentsname}{Gliederung}}
-""" + font_latex + r"""
-\usepackage{setspace}
-\usepackage{geometry}
-\usepackage{fancyhdr}
-\geometry{left=2cm, right=2cm, top=2.5cm, bottom=3cm}
-\setcounter{tocdepth}{9}
-\setcounter{secnumdepth}{9}
-\setlength{\parindent}{0pt}
-
-\fancypagestyle{iustwrite}{
-    \fancyhf{}
-    \fancyhead[L]{\small """ + kl_kuerzel + r"""}
-    \fancyhead[R]{\small """ + titel_komp + r"""}
-    \fancyfoot[R]{\thepage}
-    \renewcommand{\headrulewidth}{0.5pt}
-}
-
-\begin{document}
-\sloppy
-\pagenumbering{gobble}
-\tableofcontents\clearpage
-\newgeometry{left=2cm, right=""" + rand_wert + r""", top=2.5cm, bottom=3cm}
-\pagenumbering{arabic}
-\setcounter{page}{1}
-\pagestyle{iustwrite}\setstretch{""" + zeilenabstand + r"""}
-{\noindent\Large\bfseries """ + titel_komp + r""" \par}\bigskip
-""" + parsed_content + r"""
-\end{document}"""
-
+        # Der Inhalt kommt aus dem gecachten Builder (kein Neuaufbau bei unveränderten Eingaben);
+        # der Callable läuft in einem eigenen Thread und bekommt daher keinen Session-Zustand.
         st.download_button(
             label="📄 Als TEX speichern",
-            data=full_tex_code,
+            data=lambda: build_latex_document(
+                current_text, kl_titel, kl_datum, kl_kuerzel, rand_wert, zeilenabstand,
+                selected_font_package, schema=gliederung_schema
+            ),
             file_name=f"{dateiname_basis}.tex",
             mime="text/x-tex",
             use_container_width=True
@@ -542,129 +2093,221 @@ def main():
 
     with col_sachverhalt: 
         sachverhalt_file = st.file_uploader("📄 Sachverhalt beifügen (PDF)", type=['pdf'], key="sachverhalt_key")
+        # Upload entfernt: abgelegte Datei nicht bis zum Ablauf liegen lassen
+        if sachverhalt_file is None and "sachverhalt_store" in st.session_state:
+            discard_sachverhalt(st.session_state.pop("sachverhalt_store")[2])
+        sachverhalt_merge = st.checkbox(
+            "Erst nach dem LaTeX-Lauf voranstellen", value=True, key="sachverhalt_merge",
+            help="Schneller bei großen (gescannten) PDFs: Der Sachverhalt wird an das fertige Gutachten "
+                 "angefügt, statt in jedem LaTeX-Lauf eingebettet zu werden."
+        )
+
+    scheduler = get_compile_scheduler()
+    session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
+
+    # Namen für das PDF nach dem gleichen Schema generieren
+    pdf_name = f"{dateiname_basis}.pdf"
 
     if pdf_button:
         if not current_text.strip():
             st.warning("Bitte Text eingeben!")
         else:
-            cls_path = os.path.join("latex_assets", "jurabook.cls")
+            cls_path = os.path.join(ASSETS_FOLDER, "jurabook.cls")
             if not os.path.exists(cls_path):
                 st.error("🚨 jurabook.cls fehlt!")
                 st.stop()
 
-            with st.spinner("PDF wird erstellt..."):
-                parsed_content = doc_parser.parse_content(current_text.split('\n'))
-                if kl_datum.strip():
-                    titel_komp = f"{kl_titel} ({kl_datum})"
+            sachverhalt_cmd = ""
+            sachverhalt_id = None
+            sachverhalt_path = None
+            if sachverhalt_file is not None:
+                # Pro Upload nur einmal hashen und ablegen
+                sv_state = st.session_state.get("sachverhalt_store")
+                if sv_state is None or sv_state[0] != sachverhalt_file.file_id or not os.path.exists(sv_state[2]):
+                    sha, pfad = store_sachverhalt(sachverhalt_file)
+                    if sv_state is not None:
+                        discard_sachverhalt(sv_state[2])  # alten Link der Session freigeben
+                    sv_state = (sachverhalt_file.file_id, sha, str(pfad))
+                    st.session_state["sachverhalt_store"] = sv_state
+                _, sha, sachverhalt_path = sv_state
+                if sachverhalt_merge:
+                    sachverhalt_id = f"{sha}:merge"
                 else:
-                    titel_komp = kl_titel
-                
-                font_latex = f"\\usepackage{{{selected_font_package}}}"
-                if "helvet" in selected_font_package: font_latex += "\n\\renewcommand{\\familydefault}{\\sfdefault}"
+                    sachverhalt_id = sha
+                    sachverhalt_cmd = r"\includepdf[pages=-]{temp_sv.pdf}"
 
-                full_latex_header = r"""\documentclass[12pt, a4paper, oneside]{jurabook}
-\usepackage[ngerman]{babel}
-\usepackage[utf8]{inputenc}
-\usepackage[T1]{fontenc}
-\usepackage{pdfpages}
-\usepackage[hidelinks]{hyperref}
-\usepackage{xurl}
-\usepackage{xcolor}
+            # Kein zusammengefügter Gesamtstring: Kopf, Zeilen-Chunks und Schluss werden gestreamt
+            head, tail = latex_document_frame(
+                kl_titel, kl_datum, kl_kuerzel, rand_wert, zeilenabstand,
+                selected_font_package, sachverhalt_cmd
+            )
+            body_chunks = doc_model.chunks
 
-% --- Textfarben mir Alias ---
-\definecolor{myRed}{RGB}{190, 20, 20}
-\definecolor{myBlue}{RGB}{0, 80, 160}
-\definecolor{myGreen}{RGB}{0, 120, 50}
+            # Schnelle Prüfung in Python: offensichtliche Fehler gar nicht erst kompilieren
+            lint_issues = lint_latex(body_chunks)
+            lint_fehler = [i for i in lint_issues if i.severity == "error"]
+            lint_hinweise = [i for i in lint_issues if i.severity != "error"]
+            if lint_hinweise:
+                st.warning("\n".join(f"- Zeile {i.line}: {i.message}" for i in lint_hinweise))
+            if lint_fehler:
+                count_event("lint_blocked")
+                st.error("🚨 Bitte zuerst korrigieren:\n" + "\n".join(f"- Zeile {i.line}: {i.message}" for i in lint_fehler))
+                st.stop()
 
-\newcommand{\red}[1]{{\color{myRed}#1}}
-\newcommand{\blue}[1]{{\color{myBlue}#1}}
-\newcommand{\green}[1]{{\color{myGreen}#1}}
+            # Identischer Quelltext + Sachverhalt + Assets -> fertiges PDF aus dem Cache
+            cache_key = pdf_cache_key(
+                iter_latex_chunks(head, body_chunks, tail), sachverhalt_id, asset_fingerprint(ASSETS_FOLDER)
+            )
+            pdf_bytes = pdf_cache_get(cache_key)
+            if pdf_bytes is not None:
+                # Ein noch laufender Build mit älterem Text darf das Ergebnis nicht überschreiben
+                scheduler.discard(session_id)
+                st.session_state["pdf_result"] = {"pdf": pdf_bytes, "log": b""}
+            else:
+                # Warmstart mit .aux/.toc des letzten Builds dieser Session
+                scheduler.submit(
+                    session_id, cache_key, compile_document, head, body_chunks, tail,
+                    sachverhalt_path=sachverhalt_path, sachverhalt_merge=sachverhalt_merge,
+                    warm_aux=st.session_state.get("latex_aux_state"), cache_key=cache_key
+                )
+                st.session_state.pop("pdf_result", None)
 
-\addto\captionsngerman{\renewcommand{\contentsname}{Gliederung}}
+    # --- STATUS DES KOMPILIERVORGANGS (POLLT OHNE DAS SKRIPT ZU BLOCKIEREN) ---
+    @st.fragment(run_every=1.0)
+    def compile_status():
+        job = scheduler.job_for(session_id)
+        if job is None:
+            return
+        if not job.future.done():
+            position = scheduler.position(job)
+            if position:
+                st.info(f"⏳ PDF wartet auf einen freien Platz (Position {position} in der Warteschlange) ...")
+            else:
+                st.info("⚙️ PDF wird erstellt...")
+            if st.button("⛔ Abbrechen", key="compile_cancel"):
+                scheduler.cancel(job)
+            return
+        scheduler.release(session_id, job)
+        if not job.future.cancelled():
+            try:
+                job_result = job.future.result()
+            except Exception as e:
+                job_result = {"pdf": None, "log": str(e).encode("utf-8"), "messages": []}
+            if job_result.get("pdf") is not None:
+                st.session_state["latex_aux_state"] = job_result["aux_state"]
+            st.session_state["pdf_result"] = job_result
+        st.rerun(scope="app")
 
-""" + font_latex + r"""
-\usepackage{setspace}
-\usepackage{geometry}
-\usepackage{fancyhdr}
-\geometry{left=2cm, right=2cm, top=2.5cm, bottom=3cm}
-\setcounter{tocdepth}{8}
-\setcounter{secnumdepth}{8}
-\setlength{\parindent}{0pt}
+    job = scheduler.job_for(session_id)
+    if job is not None:
+        compile_status()
 
-\fancypagestyle{iustwrite}{
-    \fancyhf{}
-    \fancyhead[L]{\small """ + kl_kuerzel + r"""}
-    \fancyhead[R]{\small """ + titel_komp + r"""}
-    \fancyfoot[R]{\thepage}
-    \renewcommand{\headrulewidth}{0.5pt}
-    \fancyhfoffset[R]{0pt}
-}
-\begin{document}
-\sloppy
-"""
-                with tempfile.TemporaryDirectory() as tmpdirname:
-                    tmp_path = Path(tmpdirname)
-                    shutil.copy(os.path.abspath(cls_path), tmp_path / "jurabook.cls")
-                    
-                    assets_folder = os.path.abspath("latex_assets")
-                    if os.path.exists(assets_folder):
-                        for item in os.listdir(assets_folder):
-                            s = os.path.join(assets_folder, item)
-                            d = os.path.join(tmpdirname, item)
-                            if os.path.isfile(s) and not item.endswith('.cls'):
-                                shutil.copy2(s, d)
-
-                    sachverhalt_cmd = ""
-                    if sachverhalt_file is not None:
-                        with open(tmp_path / "temp_sv.pdf", "wb") as f:
-                            f.write(sachverhalt_file.getbuffer())
-                        sachverhalt_cmd = r"\includepdf[pages=-]{temp_sv.pdf}"
-
-                    final_latex = full_latex_header + sachverhalt_cmd + r"""
-\pagenumbering{gobble}
-\tableofcontents\clearpage
-\newgeometry{left=2cm, right=""" + rand_wert + r""", top=2.5cm, bottom=3cm}
-\pagenumbering{arabic}
-\setcounter{page}{1}
-\pagestyle{iustwrite}\setstretch{""" + zeilenabstand + r"""}
-{\noindent\Large\bfseries """ + titel_komp + r""" \par}\bigskip
-""" + parsed_content + r"\end{document}"
-
-                    with open(tmp_path / "klausur.tex", "w", encoding="utf-8") as f:
-                        f.write(final_latex)
-                    
-                    env = os.environ.copy()
-                    env["TEXINPUTS"] = f".:{tmp_path}:{assets_folder}:"
-
-                    result = None
-                    for _ in range(2):
-                        result = subprocess.run(
-                            ["pdflatex", "-interaction=nonstopmode", "klausur.tex"], 
-                            cwd=tmpdirname, env=env, capture_output=True, text=False
-                        )
-
-                    pdf_file = tmp_path / "klausur.pdf"
-                    if pdf_file.exists():
-                        st.success("PDF erfolgreich erstellt!")
-                        with open(pdf_file, "rb") as f:
-                            # Namen für das PDF nach dem gleichen Schema generieren
-                            t_pdf = (kl_titel or "Gutachten").replace(" ", "_")
-                            d_pdf = (kl_datum or "Datum").replace(" ", "_")
-                            k_pdf = (kl_kuerzel or "Kuerzel").replace(" ", "_")
-                            
-                            pdf_name = f"{t_pdf}_{d_pdf}_{k_pdf}.pdf"
-                            
-                            st.download_button(
-                                label="📥 Download PDF", 
-                                data=f, 
-                                file_name=pdf_name, 
-                                use_container_width=True
-                            )
-                    else:
-                        st.error("LaTeX Fehler!")
-                        if result:
-                            error_log = result.stdout.decode('utf-8', errors='replace')
-                            st.code(error_log)
+    pdf_result = st.session_state.get("pdf_result")
+    if pdf_result is not None:
+        if pdf_result["pdf"] is not None:
+            st.success("PDF erfolgreich erstellt!")
+            # Nach dem Download wird das PDF aus dem Session-Speicher entfernt
+            st.download_button(
+                label="📥 Download PDF", 
+                data=pdf_result["pdf"], 
+                file_name=pdf_name, 
+                on_click=lambda: st.session_state.pop("pdf_result", None),
+                use_container_width=True
+            )
+        else:
+            exit_reason = (pdf_result.get("metrics") or [{}])[-1].get("exit_reason")
+            if exit_reason == "cancelled":
+                st.info("PDF-Erstellung abgebrochen.")
+            elif exit_reason in ("timeout", "signal"):
+                st.error(f"⏱️ PDF-Erstellung nach {int(PDFLATEX_TIMEOUT_S)} Sekunden bzw. am Ressourcenlimit abgebrochen. Bitte den Text auf Endlosschleifen (z.B. rekursive Befehle) prüfen.")
+            else:
+                st.error("LaTeX Fehler!")
+            fehler = [m for m in pdf_result.get("messages", []) if m.severity == "error"]
+            if fehler:
+                st.markdown("\n".join(f"- {format_log_message(m)}" for m in fehler))
+            if pdf_result["log"]:
+                with st.expander("Vollständiges LaTeX-Protokoll"):
+                    error_log = pdf_result["log"].decode('utf-8', errors='replace')
+                    st.code(error_log)
+        warnungen = [m for m in pdf_result.get("messages", []) if m.severity == "warning" and m.editor_line is not None]
+        if warnungen:
+            with st.expander(f"⚠️ Satzhinweise ({len(warnungen)})"):
+                st.markdown("\n".join(f"- {format_log_message(m)}" for m in warnungen))
+
+    # --- VORSCHAU (EIN ABSCHNITT STATT DES GANZEN DOKUMENTS) ---
+    with st.expander("🔍 Vorschau (einzelner Abschnitt)", expanded=False):
+        vorschau_session = f"{session_id}:vorschau"
+        outline = doc_model.outline()
+        auswahl = st.selectbox(
+            "Abschnitt", [None] + outline,
+            format_func=lambda e: "Dokumentanfang" if e is None else f"{e.text} (Zeile {e.line + 1})",
+            key="vorschau_abschnitt"
+        )
+        if st.button("🔍 Vorschau erzeugen", disabled=not current_text.strip()):
+            body_chunks = doc_model.chunks
+            if auswahl is None:
+                # Text vor der ersten Überschrift, sonst der erste Abschnitt
+                if outline and outline[0].line > 0:
+                    start, ende = 0, outline[0].line
+                elif outline:
+                    start, ende = section_range(outline, outline[0].line, len(doc_model))
+                else:
+                    start, ende = 0, len(doc_model)
+            else:
+                start, ende = section_range(outline, auswahl.line, len(doc_model))
+            head, tail = latex_document_frame(
+                kl_titel, kl_datum, kl_kuerzel, rand_wert, zeilenabstand, selected_font_package, vorschau=True
+            )
+            ausschnitt = body_chunks[start:ende]
+            vorschau_key = pdf_cache_key(iter_latex_chunks(head, ausschnitt, tail), None, "vorschau")
+            scheduler.submit(
+                vorschau_session, vorschau_key, compile_preview, head, ausschnitt, tail, first_line=start + 1
+            )
+            st.session_state.pop("vorschau_result", None)
+
+        # Wie compile_status: pollt, ohne das Skript zu blockieren
+        @st.fragment(run_every=1.0)
+        def preview_status():
+            job = scheduler.job_for(vorschau_session)
+            if job is None:
+                return
+            if not job.future.done():
+                position = scheduler.position(job)
+                if position and time.monotonic() - job.submitted_at > PREVIEW_TIMEOUT_S:
+                    # Zu lange in der Warteschlange: Vorschau verwerfen statt einen Platz zu belegen
+                    scheduler.discard(vorschau_session)
+                    st.session_state["vorschau_result"] = ([], [], "queue_timeout")
+                    st.rerun(scope="app")
+                if position:
+                    st.info(f"⏳ Vorschau wartet auf einen freien Platz (Position {position}) ...")
+                else:
+                    st.info("⚙️ Vorschau wird erstellt...")
+                return
+            scheduler.release(vorschau_session, job)
+            if not job.future.cancelled():
+                try:
+                    st.session_state["vorschau_result"] = job.future.result()
+                except Exception:
+                    st.session_state["vorschau_result"] = ([], [], "error")
+            st.rerun(scope="app")
+
+        if scheduler.job_for(vorschau_session) is not None:
+            preview_status()
+
+        vorschau_result = st.session_state.get("vorschau_result")
+        if vorschau_result is not None:
+            bilder, messages, exit_reason = vorschau_result
+            if bilder:
+                st.image(bilder, caption=[f"Seite {i}" for i in range(1, len(bilder) + 1)], use_container_width=True)
+            elif exit_reason == "queue_timeout":
+                st.warning("Der Server ist gerade ausgelastet - bitte die Vorschau gleich noch einmal anfordern.")
+            elif exit_reason in ("timeout", "signal"):
+                st.warning(f"Die Vorschau wurde nach {PREVIEW_TIMEOUT_S} Sekunden abgebrochen - bitte einen kleineren Abschnitt wählen oder den Text auf Endlosschleifen prüfen.")
+            else:
+                st.error("Vorschau fehlgeschlagen.")
+                fehler = [m for m in messages if m.severity == "error"]
+                if fehler:
+                    st.markdown("\n".join(f"- {format_log_message(m)}" for m in fehler))
 
 if __name__ == "__main__":
     main()
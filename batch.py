@@ -0,0 +1,178 @@
+"""Stapelverarbeitung ohne Browser: wandelt viele .txt-Gutachten in .tex/.pdf um.
+
+Beispiele:
+    python batch.py fealle/ -o out/
+    python batch.py "abgaben/AG3/*.txt" -o out/ --format pdf --rand 5 --schrift Times -j 8
+
+Nutzt dieselbe Vorlage und denselben Parser wie der Editor (app.py). Jede Datei wird in
+einem eigenen Prozess geparst und kompiliert; die Ordnerstruktur der Eingaben wird im
+Zielverzeichnis gespiegelt. Am Ende steht ein manifest.json mit Status, Zeiten und
+Fehlern pro Datei.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import app  # schaltet ohne laufende App die Streamlit-Warnungen ab (silence_bare_mode)
+
+# Die Laufzeiten stehen im Manifest; die compile-Zeilen je pdflatex-Lauf nur auf Wunsch
+if "IUSTWRITE_LOG_LEVEL" not in os.environ:
+    app.logger.setLevel(logging.WARNING)
+
+# --- EINGABEN SAMMELN ---
+def collect_inputs(patterns):
+    """Verzeichnisse (alle *.txt darin) und Glob-Muster zu einer sortierten Dateiliste."""
+    dateien = []
+    for muster in patterns:
+        if os.path.isdir(muster):
+            dateien.extend(Path(muster).glob("*.txt"))
+        else:
+            dateien.extend(Path(p) for p in glob.glob(muster, recursive=True))
+    return sorted({d.resolve() for d in dateien if d.is_file()})
+
+def output_stems(dateien, out_dir):
+    """Zielpfad (ohne Endung) je Eingabe: Verzeichnisstruktur ab dem gemeinsamen Elternordner
+    wird gespiegelt, damit gleichnamige Dateien aus verschiedenen Ordnern sich nicht überschreiben."""
+    basis = Path(os.path.commonpath([d.parent for d in dateien]))
+    return {d: Path(out_dir) / d.relative_to(basis).with_suffix("") for d in dateien}
+
+# --- EIN AUFTRAG (LÄUFT IM WORKER-PROZESS) ---
+_parser = None
+
+def convert_file(source, target, options):
+    """Parst eine Datei, schreibt `target`.tex und/oder `target`.pdf und liefert den Manifest-Eintrag."""
+    global _parser
+    if _parser is None:
+        _parser = app.KlausurDocument(options["schema"])
+
+    source = Path(source)
+    target = Path(target)
+    eintrag = {"source": str(source), "status": "ok", "errors": [], "timings": {}}
+    start = time.perf_counter()
+    try:
+        text = source.read_text(encoding="utf-8")
+        body_chunks = list(_parser.iter_content(text.split('\n')))
+        eintrag["timings"]["parse_s"] = round(time.perf_counter() - start, 4)
+
+        # Dateinamen wie "Mueller_AG3" enthalten LaTeX-Sonderzeichen
+        head, tail = app.latex_document_frame(
+            options["titel"] or _parser.escape_latex(source.stem), options["datum"], options["kuerzel"],
+            options["rand"], options["zeilenabstand"], options["font_package"]
+        )
+        eintrag["errors"].extend(
+            f"Zeile {issue.line}: {issue.message}"
+            for issue in app.lint_latex(body_chunks) if issue.severity == "error"
+        )
+        if eintrag["errors"]:
+            eintrag["status"] = "lint_error"
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if options["format"] in ("tex", "both"):
+            tex_path = target.parent / f"{target.name}.tex"
+            with open(tex_path, "w", encoding="utf-8") as f:
+                f.writelines(app.iter_latex_chunks(head, body_chunks, tail))
+            eintrag["tex"] = str(tex_path)
+
+        if options["format"] in ("pdf", "both"):
+            if eintrag["errors"]:
+                return eintrag
+            compile_start = time.perf_counter()
+            ergebnis = app.compile_document(head, body_chunks, tail)
+            eintrag["timings"]["compile_s"] = round(time.perf_counter() - compile_start, 3)
+            eintrag["timings"]["passes_s"] = [m["duration_s"] for m in ergebnis["metrics"]]
+            eintrag["passes"] = ergebnis["passes"]
+            eintrag["errors"].extend(
+                app.format_log_message(m) for m in ergebnis["messages"] if m.severity == "error"
+            )
+            if ergebnis["pdf"] is None:
+                reason = ergebnis["metrics"][-1]["exit_reason"] if ergebnis["metrics"] else "error"
+                eintrag["status"] = reason if reason != "ok" else "error"
+            else:
+                pdf_path = target.parent / f"{target.name}.pdf"
+                pdf_path.write_bytes(ergebnis["pdf"])
+                eintrag["pdf"] = str(pdf_path)
+    except Exception as e:
+        eintrag["status"] = "error"
+        eintrag["errors"].append(f"{type(e).__name__}: {e}")
+    finally:
+        eintrag["timings"]["total_s"] = round(time.perf_counter() - start, 3)
+    return eintrag
+
+# --- KOMMANDOZEILE ---
+def build_arg_parser():
+    ap = argparse.ArgumentParser(description="IustWrite-Gutachten (.txt) stapelweise nach .tex/.pdf umwandeln.")
+    ap.add_argument("inputs", nargs="+", help="Verzeichnisse oder Glob-Muster (z.B. 'abgaben/**/*.txt')")
+    ap.add_argument("-o", "--out-dir", default="iustwrite_out", help="Zielverzeichnis (Standard: iustwrite_out)")
+    ap.add_argument("--format", choices=["tex", "pdf", "both"], default="both")
+    ap.add_argument("--rand", default="6", help="Korrekturrand rechts (Standard: 6cm)")
+    ap.add_argument("--zeilenabstand", choices=app.ZEILENABSTAND_OPTIONS, default="1.2")
+    ap.add_argument("--schrift", choices=[name.split(" ")[0] for name in app.FONT_OPTIONS], default="lmodern")
+    ap.add_argument("--gliederung", choices=list(app.GLIEDERUNGSSCHEMATA), default=app.GLIEDERUNG_STANDARD,
+                    help="Gliederungsschema (Standard: jurabook)")
+    ap.add_argument("--titel", default="", help="Titel für alle Dateien (Standard: Dateiname)")
+    ap.add_argument("--datum", default="")
+    ap.add_argument("--kuerzel", default="")
+    ap.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="Anzahl paralleler Prozesse")
+    ap.add_argument("--manifest", default=None, help="Pfad des Manifests (Standard: <out-dir>/manifest.json)")
+    return ap
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    dateien = collect_inputs(args.inputs)
+    if not dateien:
+        print("Keine .txt-Dateien gefunden.", file=sys.stderr)
+        return 2
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    font_package = next(pkg for name, pkg in app.FONT_OPTIONS.items() if name.split(" ")[0] == args.schrift)
+    options = {
+        "format": args.format,
+        "rand": app.normalize_rand(args.rand),
+        "zeilenabstand": args.zeilenabstand,
+        "font_package": font_package,
+        "schema": args.gliederung,
+        "titel": args.titel,
+        "datum": args.datum,
+        "kuerzel": args.kuerzel,
+    }
+
+    if args.format in ("pdf", "both"):
+        # Präambel-Format einmal vorab bauen, statt es in jedem Worker parallel zu erzeugen
+        head, _ = app.latex_document_frame("", "", "", options["rand"], options["zeilenabstand"], font_package)
+        app.ensure_preamble_format(head, app.ASSETS_FOLDER)
+
+    start = time.perf_counter()
+    eintraege = []
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        ziele = output_stems(dateien, out_dir)
+        futures = [pool.submit(convert_file, str(d), str(ziele[d]), options) for d in dateien]
+        for future in as_completed(futures):
+            eintrag = future.result()
+            eintraege.append(eintrag)
+            print(f"[{len(eintraege)}/{len(dateien)}] {eintrag['status']:<10} {eintrag['source']}")
+    eintraege.sort(key=lambda e: e["source"])
+
+    fehlgeschlagen = sum(e["status"] != "ok" for e in eintraege)
+    manifest = {
+        "options": options,
+        "jobs": args.jobs,
+        "total_s": round(time.perf_counter() - start, 3),
+        "files": len(eintraege),
+        "failed": fehlgeschlagen,
+        "results": eintraege,
+    }
+    manifest_path = Path(args.manifest) if args.manifest else out_dir / "manifest.json"
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    print(f"{len(eintraege) - fehlgeschlagen}/{len(eintraege)} erfolgreich, Manifest: {manifest_path}")
+    return 1 if fehlgeschlagen else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""Benchmarks für Parser, Rerun-Arbeit und pdflatex mit synthetischen Gutachten.
+
+Beispiele:
+    python bench.py                               # Standardgröße, Vergleich mit bench_baseline.json
+    python bench.py --lines 20000 --footnotes 0.5 --save-baseline
+    python bench.py --compile                     # zusätzlich pdflatex-Zeiten je Lauf
+    python bench.py --dump synthetisch.txt        # erzeugten Text zum Ausprobieren im Editor ablegen
+
+Die Gutachten werden aus Sätzen der Fälle in fealle/ zusammengesetzt; Überschriften
+(alle neun Ebenen, Sternchen, Fettdruck), Fußnoten und Sonderzeichen lassen sich
+über die Optionen dosieren. Gleicher Seed = gleicher Text.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import app  # schaltet ohne laufende App die Streamlit-Warnungen ab (silence_bare_mode)
+
+# --- GENERATOR FÜR SYNTHETISCHE GUTACHTEN ---
+ROEMISCH = ["I", "II", "III", "IV", "V", "VI", "VII", "VIII", "IX", "X",
+            "XI", "XII", "XIII", "XIV", "XV", "XVI", "XVII", "XVIII", "XIX", "XX"]
+BUCHSTABEN = "abcdefghijklmnopqrstuvwxyz"
+SONDERZEICHEN = "&%$#_^"
+FUSSNOTEN = ["BGH NJW 2020, 1234 (1236)", "BVerfGE 39, 1 (42)", "MüKo-BGB/Ernst, § 280 Rn. 12",
+             "Schönke/Schröder/Eser, StGB, § 242 Rn. 3 (m.w.N.)", "Vgl. Maurer, AllgVwR, § 9 Rn. 2"]
+# Standardgewichte der Ebenen 1-9: flache Ebenen selten, mittlere am häufigsten
+LEVEL_WEIGHTS = (1, 3, 5, 6, 5, 3, 2, 1, 1)
+SATZ_RE = re.compile(r"(?<=[.!?])\s+")
+
+def load_sentences(corpus_dir):
+    saetze = []
+    for pfad in sorted(Path(corpus_dir).glob("*.txt")):
+        for absatz in pfad.read_text(encoding="utf-8").split("\n"):
+            saetze.extend(s.strip() for s in SATZ_RE.split(absatz) if len(s.strip()) > 20)
+    return saetze or ["Der Anspruch könnte sich aus § 280 Abs. 1 BGB ergeben."]
+
+def marker(level, nummer, starred):
+    """Gliederungsmarke für Ebene `level` mit laufender Nummer (1-basiert)."""
+    if level == 1:
+        basis = f"{('Teil', 'Tatkomplex', 'Aufgabe')[nummer % 3]} {nummer}"
+        return basis + ("*" if starred else ".")
+    if level == 2:
+        basis = "ABCDEFGH"[(nummer - 1) % 8]
+        return basis + ("*" if starred else ".")
+    if level == 3:
+        basis = ROEMISCH[(nummer - 1) % len(ROEMISCH)]
+        return basis + ("*" if starred else ".")
+    if level == 4:
+        return f"{nummer}" + ("*" if starred else ".")
+    if level == 5:
+        return BUCHSTABEN[(nummer - 1) % 26] + (")*" if starred else ")")
+    if level == 6:
+        return BUCHSTABEN[(nummer - 1) % 26] * 2 + ")"
+    if level == 7:
+        return f"({nummer})"
+    if level == 8:
+        return f"({BUCHSTABEN[(nummer - 1) % 26]})"
+    return f"({BUCHSTABEN[(nummer - 1) % 26] * 2})"
+
+def generate_gutachten(lines=2000, level_weights=LEVEL_WEIGHTS, headings=0.15, starred=0.05, bold=0.1,
+                       footnotes=0.2, specials=0.05, blank=0.1, seed=0, corpus_dir="fealle"):
+    """Erzeugt ein synthetisches Gutachten mit `lines` Zeilen.
+
+    `headings`, `blank`, `footnotes` sind Anteile je Zeile, `starred`/`bold` Anteile
+    der Überschriften, `specials` der Anteil der Wortzwischenräume mit Sonderzeichen.
+    """
+    rng = random.Random(seed)
+    saetze = load_sentences(corpus_dir)
+    zaehler = [0] * 10
+    out = []
+    for _ in range(lines):
+        wurf = rng.random()
+        if wurf < headings:
+            level = rng.choices(range(1, 10), weights=level_weights)[0]
+            zaehler[level] += 1
+            for tiefer in range(level + 1, 10):
+                zaehler[tiefer] = 0
+            stern = level <= 5 and rng.random() < starred
+            zeile = marker(level, zaehler[level], stern) + " " + rng.choice(saetze)[:60]
+            if not stern and level > 1 and rng.random() < bold:
+                zeile += "*"
+            out.append(zeile)
+        elif wurf < headings + blank:
+            out.append("")
+        else:
+            woerter = " ".join(rng.choice(saetze) for _ in range(rng.randint(1, 4))).split(" ")
+            for i in range(1, len(woerter)):
+                if rng.random() < specials:
+                    woerter[i] = rng.choice(SONDERZEICHEN) + woerter[i]
+            zeile = " ".join(woerter)
+            if rng.random() < footnotes:
+                zeile += f" \\fn({rng.choice(FUSSNOTEN)})"
+            out.append(zeile)
+    return "\n".join(out)
+
+# --- MESSUNGEN ---
+def measure(func, repeat, min_time=0.2):
+    """Median der Laufzeit in Sekunden (mindestens `repeat` Läufe bzw. `min_time` Sekunden)."""
+    zeiten = []
+    start = time.perf_counter()
+    while len(zeiten) < repeat or time.perf_counter() - start < min_time:
+        t0 = time.perf_counter()
+        func()
+        zeiten.append(time.perf_counter() - t0)
+        if len(zeiten) >= 1000:
+            break
+    return statistics.median(zeiten)
+
+def rerun_work(parser, text, model):
+    """Entspricht der Arbeit, die main() bei jedem Rerun mit Text erledigt
+    (Modell abgleichen, Zähler, Gliederung für die Sidebar)."""
+    model.update(text, parser)
+    model.char_count
+    model.word_count
+    zeilen_html = [
+        f"{'&nbsp;' * (entry.level * 2)}{entry.text}"
+        for entry in model.outline()
+    ]
+    "<br>".join(zeilen_html)
+
+def bench_parser(text, repeat):
+    parser = app.KlausurDocument()
+    lines = text.split('\n')
+    ergebnisse = {}
+
+    ergebnisse["parse_full_s"] = measure(lambda: parser.parse_content(lines), repeat)
+
+    # Tippen in der Mitte des Dokuments: eine Zeile ändert sich pro Rerun
+    model = app.DocumentModel()
+    model.update(text, parser)
+    mitte = model.starts[len(model) // 2]
+    zaehler = [0]
+
+    def edit_one_line():
+        zaehler[0] += 1
+        model.update(text[:mitte] + "x" * (zaehler[0] % 7) + text[mitte:], parser)
+    ergebnisse["parse_incremental_edit_s"] = measure(edit_one_line, repeat)
+
+    def outline_only():
+        model._outline = None  # Gliederung neu aufbauen, ohne neu zu parsen
+        model.outline()
+    ergebnisse["outline_s"] = measure(outline_only, repeat)
+
+    rerun_model = app.DocumentModel()
+    rerun_work(parser, text, rerun_model)
+    ergebnisse["rerun_idle_s"] = measure(lambda: rerun_work(parser, text, rerun_model), repeat)
+
+    def rerun_after_edit():
+        zaehler[0] += 1
+        rerun_work(parser, text + "x" * (zaehler[0] % 7), rerun_model)
+    ergebnisse["rerun_edit_s"] = measure(rerun_after_edit, repeat)
+
+    body_chunks = list(parser.iter_content(lines))
+    ergebnisse["lint_s"] = measure(lambda: app.lint_latex(body_chunks), repeat)
+    return ergebnisse
+
+def bench_compile(text, repeat):
+    """pdflatex-Wandzeit: kalter Build (ohne .aux) und warmer Build (mit .aux/.toc)."""
+    parser = app.KlausurDocument()
+    body_chunks = list(parser.iter_content(text.split('\n')))
+    head, tail = app.latex_document_frame("Benchmark", "", "", "6cm", "1.2", "lmodern")
+    app.ensure_preamble_format(head, app.ASSETS_FOLDER)
+
+    ergebnisse = {}
+    kalt, warm, kalt_laeufe, warm_laeufe = [], [], [], []
+    for _ in range(repeat):
+        ergebnis = app.compile_document(head, body_chunks, tail)
+        if ergebnis["pdf"] is None:
+            raise RuntimeError("pdflatex lieferte kein PDF: " + ergebnis["log"][-500:].decode("utf-8", "replace"))
+        kalt.append(sum(m["duration_s"] for m in ergebnis["metrics"]))
+        kalt_laeufe.extend(m["duration_s"] for m in ergebnis["metrics"])
+        ergebnis = app.compile_document(head, body_chunks, tail, warm_aux=ergebnis["aux_state"])
+        warm.append(sum(m["duration_s"] for m in ergebnis["metrics"]))
+        warm_laeufe.extend(m["duration_s"] for m in ergebnis["metrics"])
+    ergebnisse["compile_cold_s"] = statistics.median(kalt)
+    ergebnisse["compile_warm_s"] = statistics.median(warm)
+    ergebnisse["pdflatex_pass_s"] = statistics.median(kalt_laeufe + warm_laeufe)
+    ergebnisse["passes_cold"] = len(kalt_laeufe) / repeat
+    ergebnisse["passes_warm"] = len(warm_laeufe) / repeat
+    return ergebnisse
+
+# --- BERICHT UND BASELINE ---
+def report(ergebnisse, zeilen, baseline, toleranz):
+    """Gibt die Tabelle aus und liefert die Liste der Regressionen (Zeit > Baseline * (1 + toleranz))."""
+    regressionen = []
+    print(f"{'Messung':<28}{'Wert':>14}{'Baseline':>14}{'Δ':>9}")
+    for name, wert in ergebnisse.items():
+        if name.endswith("_s"):
+            anzeige = f"{wert * 1000:.2f} ms"
+        else:
+            anzeige = f"{wert:.2f}"
+        alt = baseline.get(name)
+        if alt:
+            delta = wert / alt - 1
+            marke = " !" if name.endswith("_s") and delta > toleranz else ""
+            if marke:
+                regressionen.append(name)
+            alt_anzeige = f"{alt * 1000:.2f} ms" if name.endswith("_s") else f"{alt:.2f}"
+            print(f"{name:<28}{anzeige:>14}{alt_anzeige:>14}{delta:>+8.0%}{marke}")
+        else:
+            print(f"{name:<28}{anzeige:>14}{'-':>14}{'':>9}")
+    if ergebnisse.get("parse_full_s"):
+        print(f"\nParser: {zeilen / ergebnisse['parse_full_s']:,.0f} Zeilen/s")
+    return regressionen
+
+def build_arg_parser():
+    ap = argparse.ArgumentParser(description="Parser-/Compile-Benchmarks mit synthetischen Gutachten.")
+    ap.add_argument("--lines", type=int, default=5000, help="Zeilen des synthetischen Gutachtens")
+    ap.add_argument("--levels", default=",".join(map(str, LEVEL_WEIGHTS)),
+                    help="Gewichte der Ebenen 1-9, kommagetrennt (z.B. 1,1,1,1,1,0,0,0,0)")
+    ap.add_argument("--headings", type=float, default=0.15, help="Anteil Überschriftszeilen")
+    ap.add_argument("--starred", type=float, default=0.05, help="Anteil Sternchen-Überschriften (Ebenen 1-5)")
+    ap.add_argument("--bold", type=float, default=0.1, help="Anteil fett markierter Überschriften")
+    ap.add_argument("--footnotes", type=float, default=0.2, help="Anteil Textzeilen mit Fußnote")
+    ap.add_argument("--specials", type=float, default=0.05, help="Anteil Wörter mit Sonderzeichen")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fealle"))
+    ap.add_argument("--repeat", type=int, default=5, help="Mindestanzahl Wiederholungen je Messung")
+    ap.add_argument("--compile", action="store_true", help="auch pdflatex messen (braucht eine TeX-Installation)")
+    ap.add_argument("--baseline", default="bench_baseline.json")
+    ap.add_argument("--save-baseline", action="store_true", help="Ergebnisse als neue Baseline speichern")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="erlaubte Verlangsamung gegenüber der Baseline")
+    ap.add_argument("--dump", default=None, help="erzeugtes Gutachten in diese Datei schreiben")
+    return ap
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    level_weights = [float(w) for w in args.levels.split(",")]
+    if len(level_weights) != 9:
+        print("--levels braucht genau neun Gewichte.", file=sys.stderr)
+        return 2
+
+    text = generate_gutachten(args.lines, level_weights, args.headings, args.starred, args.bold,
+                              args.footnotes, args.specials, seed=args.seed, corpus_dir=args.corpus)
+    if args.dump:
+        Path(args.dump).write_text(text, encoding="utf-8")
+    print(f"Synthetisches Gutachten: {args.lines} Zeilen, {len(text):,} Zeichen (Seed {args.seed})\n")
+
+    ergebnisse = bench_parser(text, args.repeat)
+    if args.compile:
+        ergebnisse.update(bench_compile(text, max(1, args.repeat // 2)))
+
+    # Vergleichbar ist nur eine Baseline mit identischem Generator-Input
+    parameter = {name: getattr(args, name) for name in
+                 ("lines", "levels", "headings", "starred", "bold", "footnotes", "specials", "seed")}
+    baseline_pfad = Path(args.baseline)
+    baseline = {}
+    if baseline_pfad.exists():
+        gespeichert = json.loads(baseline_pfad.read_text(encoding="utf-8"))
+        if gespeichert.get("params") == parameter:
+            baseline = gespeichert["results"]
+        else:
+            print(f"Baseline {baseline_pfad} gilt für andere Parameter und wird ignoriert.\n")
+
+    regressionen = report(ergebnisse, args.lines, baseline, args.tolerance)
+
+    if args.save_baseline:
+        baseline_pfad.write_text(json.dumps(
+            {"params": parameter, "results": ergebnisse}, indent=2), encoding="utf-8")
+        print(f"Baseline gespeichert: {baseline_pfad}")
+    elif regressionen:
+        print(f"\nLangsamer als die Baseline (> {args.tolerance:.0%}): {', '.join(regressionen)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())